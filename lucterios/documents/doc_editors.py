@@ -32,6 +32,7 @@ from requests.exceptions import ConnectionError
 from logging import getLogger
 from lxml import etree
 from json import dumps, loads
+from mimetypes import guess_all_extensions
 
 from django.conf import settings
 from django.utils import timezone
@@ -96,15 +97,25 @@ class DocEditor(object):
         md5res.update(self.root_url.encode())
         return '%s-%d' % (md5res.hexdigest(), self.doccontainer.id)
 
+    @property
+    def doc_extensions(self):
+        if '.' in self.doccontainer.name:
+            return [self.doccontainer.name.split('.')[-1]]
+        mime_type = getattr(self.doccontainer, 'mimetype', None)
+        if mime_type is not None:
+            return [ext_item[1:] for ext_item in guess_all_extensions(mime_type)]
+        return []
+
     def is_manage(self):
         if self.doccontainer is not None:
             if hasattr(settings, self.SETTING_NAME):
+                doc_extensions = self.doc_extensions
                 for ext_item in self.extension_rw_supported():
-                    if self.doccontainer.name.endswith('.' + ext_item):
+                    if ext_item in doc_extensions:
                         return True
                 if self.readonly:
                     for ext_item in self.extension_ro_supported():
-                        if self.doccontainer.name.endswith('.' + ext_item):
+                        if ext_item in doc_extensions:
                             return True
         return False
 
@@ -127,6 +138,12 @@ class DocEditor(object):
     def close(self):
         pass
 
+    def download_content(self, download_url):
+        from requests import get
+        with get(download_url, verify=False, stream=True) as response:
+            response.raw.decode_content = True
+            self.doccontainer.upload_content(response.raw)
+
 
 def disabled_ssl():
     def decorator(fn):
@@ -384,7 +401,6 @@ class OnlyOfficeEditor(DocEditor):
         return convert_res['fileUrl']
 
     def _get_download_url(self):
-        from requests import get
         from urllib.parse import parse_qs, urlparse
         download_url = self.info_body['url']
         download_url_params = parse_qs(urlparse(download_url).query)
@@ -393,22 +409,16 @@ class OnlyOfficeEditor(DocEditor):
         if expected_extension == download_extension:
             return download_url
         else:
-            self.doccontainer.content = get(download_url, verify=False).content
+            self.download_content(download_url)
             return self._convert_download_url(download_extension, expected_extension)
 
     def uploadFile(self, info_body):
-        from requests import get
         try:
             self.info_body = loads(info_body.decode())
             if self.info_body['status'] == 2:
-                old_content = self.doccontainer.content
-                try:
-                    self.doccontainer.content = get(self._get_download_url(), verify=False).content
-                    self.doccontainer.date_modification = timezone.now()
-                    self.doccontainer.save()
-                except Exception:
-                    self.doccontainer.content = old_content
-                    raise
+                self.download_content(self._get_download_url())
+                self.doccontainer.date_modification = timezone.now()
+                self.doccontainer.save()
             responsejson = {'error': 0}
         except Exception as error:
             getLogger('lucterios.plugin').exception("uploadfile")
@@ -529,18 +539,12 @@ class CollaboraEditor(DocEditor):
         pass
 
     def uploadFile(self, info_body):
-        from requests import get
         try:
             self.info_body = loads(info_body.decode())
             if self.info_body['status'] == 2:
-                old_content = self.doccontainer.content
-                try:
-                    self.doccontainer.content = get(self._get_download_url(), verify=False).content
-                    self.doccontainer.date_modification = timezone.now()
-                    self.doccontainer.save()
-                except Exception:
-                    self.doccontainer.content = old_content
-                    raise
+                self.download_content(self._get_download_url())
+                self.doccontainer.date_modification = timezone.now()
+                self.doccontainer.save()
             responsejson = {'error': 0}
         except Exception as error:
             getLogger('lucterios.plugin').exception("uploadfile")
@@ -23,7 +23,6 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
-from os.path import isfile
 
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
@@ -64,7 +63,7 @@ class DocumentContainerEditor(LucteriosEditor):
         if 'filename' in xfer.request.FILES.keys():
             tmp_file = xfer.request.FILES['filename']
             self.item.content = tmp_file
-        elif not isfile(xfer.item.file_path):
+        elif xfer.item.isempty:
             raise LucteriosException(IMPORTANT, _("File not found!"))
 
     def edit(self, xfer):
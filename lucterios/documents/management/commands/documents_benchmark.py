@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.documents.management.commands package
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+from os import walk, unlink
+from os.path import join, dirname, getsize, isdir
+from tempfile import mkstemp
+from time import perf_counter
+from zipfile import ZipFile
+from _io import BytesIO
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lucterios.documents.models import COMPRESSION_METHODS, get_compression, get_mimetype, iter_container
+from lucterios.documents.thumbnails import MINIATURE_HEIGHTS, MINIATURE_HEIGHT, MINIATURE_CONTENT_TYPES, resize_miniatures
+
+
+class Command(BaseCommand):
+    help = 'Compare write/read throughput and disk footprint of document compression policies, or thumbnail formats'
+
+    CHUNK_SIZE = 64 * 1024
+    MOSAIC_PAGE_SIZE = 50
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--corpus', type=str, default=join(dirname(dirname(dirname(__file__))), 'docs'))
+        parser.add_argument('-r', '--repeat', type=int, default=3)
+        parser.add_argument('-t', '--thumbnails', action='store_true', default=False)
+
+    def get_corpus(self, corpus):
+        if not isdir(corpus):
+            raise CommandError('Corpus %s not found' % corpus)
+        corpus_files = []
+        for dirpath, _dirnames, filenames in walk(corpus):
+            for filename in sorted(filenames):
+                with open(join(dirpath, filename), 'rb') as corpus_file:
+                    corpus_files.append((filename, corpus_file.read()))
+        return corpus_files
+
+    def get_policies(self):
+        policies = [(method_name, lambda mime_type, method=method: (method, None)) for method_name, method in COMPRESSION_METHODS.items()]
+        policies.append(('policy', get_compression))
+        return policies
+
+    def bench_policy(self, corpus_files, compression, repeat):
+        write_time = 0.0
+        read_time = 0.0
+        disk_size = 0
+        handle, tmp_path = mkstemp()
+        try:
+            for filename, content in corpus_files:
+                compress_type, compress_level = compression(get_mimetype(content[:2048]))
+                for _index in range(repeat):
+                    start = perf_counter()
+                    with ZipFile(tmp_path, 'w', compression=compress_type, compresslevel=compress_level) as zip_ref:
+                        zip_ref.writestr(zinfo_or_arcname=filename, data=content)
+                    write_time += perf_counter() - start
+                    start = perf_counter()
+                    for _chunk in iter_container(tmp_path, self.CHUNK_SIZE):
+                        pass
+                    read_time += perf_counter() - start
+                disk_size += getsize(tmp_path)
+        finally:
+            unlink(tmp_path)
+        return write_time, read_time, disk_size
+
+    def bench_thumbnails(self, image_files, image_format, repeat):
+        from PIL import Image
+        generate_time = 0.0
+        rendition_sizes = {height: 0 for height in MINIATURE_HEIGHTS}
+        for _filename, content in image_files:
+            for _index in range(repeat):
+                start = perf_counter()
+                with Image.open(BytesIO(content)) as image:
+                    miniatures = resize_miniatures(image, MINIATURE_HEIGHTS, image_format, 80)
+                generate_time += perf_counter() - start
+            for height, miniature in miniatures.items():
+                rendition_sizes[height] += len(miniature)
+        return generate_time, rendition_sizes
+
+    def handle_thumbnails(self, corpus_files, repeat):
+        image_files = [(filename, content) for filename, content in corpus_files if get_mimetype(content[:2048]).startswith('image/') and not filename.endswith('.svg')]
+        if len(image_files) == 0:
+            raise CommandError('No image in corpus')
+        self.stdout.write(self.style.SUCCESS('*** Thumbnail benchmark: %d image(s) ***' % len(image_files)))
+        self.stdout.write("%s %s %s %s %s" % ('format'.ljust(10), 'ms/image'.rjust(10), ' '.join([('%dpx B' % height).rjust(10) for height in MINIATURE_HEIGHTS]),
+                                              'inline page'.rjust(12), 'file page'.rjust(12)))
+        for image_format in MINIATURE_CONTENT_TYPES.keys():
+            generate_time, rendition_sizes = self.bench_thumbnails(image_files, image_format, repeat)
+            average_sizes = {height: rendition_sizes[height] / len(image_files) for height in MINIATURE_HEIGHTS}
+            # bytes transferred for a full mosaic page: base64 in the JSON response, or the raw files once per browser cache
+            self.stdout.write("%s %10.1f %s %12d %12d" % (image_format.ljust(10), generate_time * 1000 / (len(image_files) * repeat),
+                                                          ' '.join(['%10d' % average_sizes[height] for height in MINIATURE_HEIGHTS]),
+                                                          self.MOSAIC_PAGE_SIZE * average_sizes[MINIATURE_HEIGHT] * 4 / 3,
+                                                          self.MOSAIC_PAGE_SIZE * average_sizes[MINIATURE_HEIGHT]))
+        self.stdout.write(self.style.SUCCESS('****************'))
+
+    def handle(self, corpus, repeat, thumbnails, *args, **options):
+        corpus_files = self.get_corpus(corpus)
+        if thumbnails:
+            self.handle_thumbnails(corpus_files, repeat)
+            return
+        raw_size = sum([len(content) for _filename, content in corpus_files])
+        self.stdout.write(self.style.SUCCESS('*** Compression benchmark: %d file(s), %d bytes ***' % (len(corpus_files), raw_size)))
+        self.stdout.write("%s %s %s %s" % ('policy'.ljust(10), 'write MB/s'.rjust(12), 'read MB/s'.rjust(12), 'disk ratio'.rjust(12)))
+        volume = raw_size * repeat / (1024 * 1024)
+        for policy_name, compression in self.get_policies():
+            write_time, read_time, disk_size = self.bench_policy(corpus_files, compression, repeat)
+            self.stdout.write("%s %12.1f %12.1f %12.3f" % (policy_name.ljust(10), volume / max(write_time, 1e-9),
+                                                           volume / max(read_time, 1e-9), disk_size / max(raw_size, 1)))
+        self.stdout.write(self.style.SUCCESS('****************'))
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.documents.management.commands package
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from lucterios.documents.models import DocumentContainer
+
+
+class Command(BaseCommand):
+    help = 'Detect and store the MIME type of documents without one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch_size', type=int, default=500)
+        parser.add_argument('-l', '--limit', type=int, default=None)
+        parser.add_argument('-p', '--pause', type=float, default=0.0)
+
+    def handle(self, batch_size, limit, pause, *args, **options):
+        self.stdout.write(self.style.SUCCESS('*** Backfill MIME types ***'))
+        doc_ids = list(DocumentContainer.objects.filter(mimetype__isnull=True).order_by('id').values_list('id', flat=True))
+        if limit is not None:
+            doc_ids = doc_ids[:limit]
+        nb_detected = 0
+        for batch_index in range(0, len(doc_ids), batch_size):
+            if (batch_index > 0) and (pause > 0):
+                sleep(pause)
+            nb_detected += self._detect_batch(doc_ids[batch_index:batch_index + batch_size])
+        self.stdout.write(self.style.SUCCESS('%d document(s) detected, %d remaining' % (nb_detected, DocumentContainer.objects.filter(mimetype__isnull=True).count())))
+
+    def _detect_batch(self, batch):
+        nb_detected = 0
+        for doc in DocumentContainer.objects.filter(id__in=batch).order_by('id'):
+            if doc.refresh_mimetype() is not None:
+                nb_detected += 1
+        if nb_detected > 0:
+            self.stdout.write('%d document(s) detected' % nb_detected)
+        return nb_detected
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.documents.management.commands package
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+from time import perf_counter
+from concurrent.futures import as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lucterios.documents.models import DocumentContainer, FolderContainer
+from lucterios.documents.thumbnails import get_thumbnails_config, get_miniature_args, create_executor, create_miniatures, save_miniatures
+
+
+class Command(BaseCommand):
+    help = 'Create missing miniatures of a folder subtree or of all documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-f', '--folder', type=int, default=None)
+        parser.add_argument('-w', '--workers', type=int, default=None)
+        parser.add_argument('-b', '--batch_size', type=int, default=100)
+        parser.add_argument('-l', '--limit', type=int, default=None)
+
+    def handle(self, folder, workers, batch_size, limit, *args, **options):
+        config = get_thumbnails_config()
+        if workers is None:
+            workers = int(config['workers'])
+        if folder is not None:
+            try:
+                folder = FolderContainer.objects.get(id=folder)
+            except FolderContainer.DoesNotExist:
+                raise CommandError('Folder %s not found' % folder)
+        self.stdout.write(self.style.SUCCESS('*** Prewarm miniatures ***'))
+        self.nb_created = 0
+        self.nb_failed = 0
+        self.volume = 0
+        self.start_time = perf_counter()
+        executor = create_executor(config, workers) if workers > 0 else None
+        try:
+            batch = []
+            for doc, miniature_request in DocumentContainer.missing_miniatures(folder):
+                if (limit is not None) and (self.nb_created + self.nb_failed + len(batch) >= limit):
+                    break
+                batch.append((doc, get_miniature_args(config, *miniature_request)))
+                if len(batch) >= batch_size:
+                    self._run_batch(executor, batch)
+                    batch = []
+            if len(batch) > 0:
+                self._run_batch(executor, batch)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        duration = max(perf_counter() - self.start_time, 1e-9)
+        self.stdout.write(self.style.SUCCESS('%d miniature(s) created, %d failed in %.1f s (%.1f doc/s, %.1f MB/s)' % (
+            self.nb_created, self.nb_failed, duration, (self.nb_created + self.nb_failed) / duration, self.volume / (1024 * 1024 * duration))))
+
+    def _run_batch(self, executor, batch):
+        if executor is None:
+            results = []
+            for doc, miniature_args in batch:
+                try:
+                    results.append((doc, create_miniatures(*miniature_args), None))
+                except Exception as err:
+                    results.append((doc, None, err))
+        else:
+            futures = {executor.submit(create_miniatures, *miniature_args): doc for doc, miniature_args in batch}
+            results = []
+            for future in as_completed(futures):
+                try:
+                    results.append((futures[future], future.result(), None))
+                except Exception as err:
+                    results.append((futures[future], None, err))
+        for doc, miniatures, err in results:
+            self.volume += doc.size if doc.size is not None else 0
+            if miniatures:
+                save_miniatures(miniatures)
+                self.nb_created += 1
+            else:
+                self.nb_failed += 1
+                self.stderr.write('document %d: miniature not created %s' % (doc.id, err if err is not None else ''))
+        duration = max(perf_counter() - self.start_time, 1e-9)
+        self.stdout.write('%d document(s) processed (%.1f doc/s)' % (self.nb_created + self.nb_failed, (self.nb_created + self.nb_failed) / duration))
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.documents.management.commands package
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+from time import sleep
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lucterios.documents.storage import get_storage, ShardedStorage
+
+
+class Command(BaseCommand):
+    help = 'Move document files from the flat directory to the sharded layout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch_size', type=int, default=500)
+        parser.add_argument('-l', '--limit', type=int, default=None)
+        parser.add_argument('-p', '--pause', type=float, default=0.0)
+
+    def handle(self, batch_size, limit, pause, *args, **options):
+        storage = get_storage()
+        if not isinstance(storage, ShardedStorage):
+            raise CommandError('Document storage is not sharded')
+        self.stdout.write(self.style.SUCCESS('*** Relocate documents ***'))
+        names = list(storage.flat_names())
+        if limit is not None:
+            names = names[:limit]
+        nb_moved = 0
+        for batch_index in range(0, len(names), batch_size):
+            if (batch_index > 0) and (pause > 0):
+                sleep(pause)
+            nb_moved += self._relocate_batch(storage, names[batch_index:batch_index + batch_size])
+        self.stdout.write(self.style.SUCCESS('%d file(s) relocated, %d remaining' % (nb_moved, len(list(storage.flat_names())))))
+
+    def _relocate_batch(self, storage, batch):
+        nb_moved = 0
+        for name in batch:
+            if storage.relocate(name):
+                nb_moved += 1
+        if nb_moved > 0:
+            self.stdout.write('%d file(s) moved' % nb_moved)
+        return nb_moved
@@ -0,0 +1,74 @@
+# Generated by Django 4.2.30 on 2026-10-18 18:53
+
+from os.path import isfile, getsize
+from zipfile import ZipFile, BadZipFile
+from hashlib import sha256
+from logging import getLogger
+
+from django.db import migrations, models
+
+from lucterios.framework.filetools import get_user_path
+
+BATCH_SIZE = 500
+CHUNK_SIZE = 64 * 1024
+
+
+def container_info(file_path):
+    content_hash = sha256()
+    content_size = 0
+    with ZipFile(file_path, 'r') as zip_ref:
+        file_list = zip_ref.namelist()
+        if len(file_list) > 0:
+            with zip_ref.open(file_list[0]) as doc_file:
+                chunk = doc_file.read(CHUNK_SIZE)
+                while chunk != b'':
+                    content_hash.update(chunk)
+                    content_size += len(chunk)
+                    chunk = doc_file.read(CHUNK_SIZE)
+    return content_size, getsize(file_path), content_hash.hexdigest()
+
+
+def backfill_fileinfo(apps, schema_editor):
+    DocumentContainer = apps.get_model("documents", "DocumentContainer")
+    doc_ids = list(DocumentContainer.objects.filter(checksum__isnull=True).order_by('pk').values_list('pk', flat=True))
+    nb_doc = 0
+    for batch_index in range(0, len(doc_ids), BATCH_SIZE):
+        for doc_id in doc_ids[batch_index:batch_index + BATCH_SIZE]:
+            file_path = get_user_path("documents", "container_%s" % doc_id)
+            if isfile(file_path):
+                try:
+                    size, compressed_size, checksum = container_info(file_path)
+                    DocumentContainer.objects.filter(pk=doc_id).update(size=size, compressed_size=compressed_size, checksum=checksum)
+                    nb_doc += 1
+                except BadZipFile:
+                    getLogger("lucterios.documents").warning('backfill_fileinfo: bad container for document %s', doc_id)
+    if nb_doc > 0:
+        getLogger("lucterios.documents").info('Backfill file info: documents=%d', nb_doc)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('documents', '0006_documentcontainer_updatemetadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentcontainer',
+            name='checksum',
+            field=models.CharField(db_index=True, max_length=64, null=True, verbose_name='checksum'),
+        ),
+        migrations.AddField(
+            model_name='documentcontainer',
+            name='compressed_size',
+            field=models.BigIntegerField(null=True, verbose_name='compressed size'),
+        ),
+        migrations.AddField(
+            model_name='documentcontainer',
+            name='size',
+            field=models.BigIntegerField(null=True, verbose_name='size'),
+        ),
+        migrations.RunPython(backfill_fileinfo, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+from os import unlink, rename
+from os.path import isfile
+from logging import getLogger
+
+from django.db import migrations
+
+from lucterios.framework.filetools import get_user_path
+
+BATCH_SIZE = 500
+
+
+def containers_to_blobs(apps, schema_editor):
+    DocumentContainer = apps.get_model("documents", "DocumentContainer")
+    docs = list(DocumentContainer.objects.filter(checksum__isnull=False).order_by('pk').values_list('pk', 'checksum'))
+    nb_doc = 0
+    for batch_index in range(0, len(docs), BATCH_SIZE):
+        for doc_id, checksum in docs[batch_index:batch_index + BATCH_SIZE]:
+            container_path = get_user_path("documents", "container_%s" % doc_id)
+            if isfile(container_path):
+                blob_path = get_user_path("documents", "blob_%s" % checksum)
+                if isfile(blob_path):
+                    unlink(container_path)
+                else:
+                    rename(container_path, blob_path)
+                nb_doc += 1
+    if nb_doc > 0:
+        getLogger("lucterios.documents").info('Convert containers to blobs: documents=%d', nb_doc)
+
+
+def blobs_to_containers(apps, schema_editor):
+    from shutil import copyfile
+    DocumentContainer = apps.get_model("documents", "DocumentContainer")
+    for doc_id, checksum in DocumentContainer.objects.filter(checksum__isnull=False).order_by('pk').values_list('pk', 'checksum'):
+        blob_path = get_user_path("documents", "blob_%s" % checksum)
+        container_path = get_user_path("documents", "container_%s" % doc_id)
+        if isfile(blob_path) and not isfile(container_path):
+            copyfile(blob_path, container_path)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('documents', '0007_documentcontainer_fileinfo'),
+    ]
+
+    operations = [
+        migrations.RunPython(containers_to_blobs, blobs_to_containers),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 500
+
+
+def fill_folderpermission(apps, schema_editor):
+    FolderContainer = apps.get_model("documents", "FolderContainer")
+    FolderPermission = apps.get_model("documents", "FolderPermission")
+    viewers = set(FolderContainer.viewer.through.objects.values_list('foldercontainer_id', 'lucteriosgroup_id'))
+    modifiers = set(FolderContainer.modifier.through.objects.values_list('foldercontainer_id', 'lucteriosgroup_id'))
+    FolderPermission.objects.bulk_create([FolderPermission(folder_id=folder_id, group_id=group_id, can_view=(folder_id, group_id) in viewers, can_modify=(folder_id, group_id) in modifiers)
+                                          for folder_id, group_id in viewers | modifiers], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CORE', '0007_shortcut'),
+        ('documents', '0008_documentcontainer_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderPermission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('can_view', models.BooleanField(default=False, verbose_name='viewer')),
+                ('can_modify', models.BooleanField(default=False, verbose_name='modifier')),
+                ('folder', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='permissions', to='documents.foldercontainer', verbose_name='folder')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='CORE.lucteriosgroup', verbose_name='group')),
+            ],
+            options={
+                'verbose_name': 'folder permission',
+                'verbose_name_plural': 'folder permissions',
+                'default_permissions': [],
+                'indexes': [models.Index(fields=['group', 'can_view', 'folder'], name='documents_folderperm_view')],
+                'unique_together': {('folder', 'group')},
+            },
+        ),
+        migrations.RunPython(fill_folderpermission, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:08
+
+from django.db import migrations, models
+
+
+def fill_folder_path(apps, schema_editor):
+    # frozen copy of FolderContainer.rebuild_paths: a migration must not follow later changes of the model code
+    AbstractContainer = apps.get_model("documents", "AbstractContainer")
+    FolderContainer = apps.get_model("documents", "FolderContainer")
+    parents = dict(FolderContainer.objects.values_list('pk', 'parent_id'))
+    paths = {}
+    for folder_id in parents.keys():
+        while folder_id not in paths:
+            ancestors = [folder_id]
+            current_id = parents[folder_id]
+            while (current_id is not None) and (current_id not in paths) and (current_id not in ancestors):
+                ancestors.append(current_id)
+                current_id = parents.get(current_id)
+            if current_id in ancestors:
+                parents[current_id] = None
+                AbstractContainer.objects.filter(pk=current_id).update(parent=None)
+                continue
+            parent_path = paths[current_id] if current_id is not None else "/"
+            for ancestor_id in reversed(ancestors):
+                paths[ancestor_id] = "%s%d/" % (parent_path, ancestor_id)
+                parent_path = paths[ancestor_id]
+    for folder_id, folder_path in paths.items():
+        FolderContainer.objects.filter(pk=folder_id).update(path=folder_path)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0009_folderpermission'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foldercontainer',
+            name='path',
+            field=models.CharField(db_index=True, max_length=500, null=True, verbose_name='path'),
+        ),
+        migrations.RunPython(fill_folder_path, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:19
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0010_foldercontainer_path'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='abstractcontainer',
+            index=models.Index(models.F('parent'), django.db.models.functions.text.Lower('name'), models.F('id'), name='documents_container_keyset'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:22
+
+from django.db import migrations, models
+from django.db.models.aggregates import Count
+
+
+def clear_duplicate_sharekeys(apps, schema_editor):
+    DocumentContainer = apps.get_model("documents", "DocumentContainer")
+    for multi_data in DocumentContainer.objects.filter(sharekey__isnull=False).values("sharekey").annotate(Count('id')).order_by().filter(id__count__gt=1):
+        doc_ids = list(DocumentContainer.objects.filter(sharekey=multi_data['sharekey']).order_by('pk').values_list('pk', flat=True))
+        DocumentContainer.objects.filter(pk__in=doc_ids[1:]).update(sharekey=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0011_container_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='abstractcontainer',
+            index=models.Index(fields=['parent', 'name'], name='documents_container_parent'),
+        ),
+        migrations.AddIndex(
+            model_name='abstractcontainer',
+            index=models.Index(fields=['name', 'parent'], name='documents_container_name'),
+        ),
+        migrations.AddIndex(
+            model_name='documentcontainer',
+            index=models.Index(fields=['date_modification', 'modifier'], name='documents_document_modif'),
+        ),
+        migrations.RunPython(clear_duplicate_sharekeys, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='documentcontainer',
+            constraint=models.UniqueConstraint(condition=models.Q(('sharekey__isnull', False)), fields=('sharekey',), name='documents_document_sharekey'),
+        ),
+    ]
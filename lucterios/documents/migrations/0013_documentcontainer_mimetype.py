@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0012_container_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentcontainer',
+            name='mimetype',
+            field=models.CharField(max_length=100, null=True, verbose_name='mimetype'),
+        ),
+    ]
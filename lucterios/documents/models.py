@@ -23,32 +23,321 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
-from os import unlink, listdir, makedirs
-from os.path import isfile, isdir, join, dirname
-from zipfile import ZipFile
+from os import unlink, listdir, makedirs, rename, lseek
+from os import read as os_read
+from os.path import isfile, isdir, join, dirname, getsize, basename, realpath, sep
+from shutil import copyfileobj
+from base64 import b64encode
+from _io import BytesIO
+from zipfile import ZipFile, is_zipfile, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
 from lucterios.CORE.parameters import notfree_mode_connect, Params
 from datetime import datetime
 from zipfile import BadZipFile
 from logging import getLogger
+from hashlib import sha256
+from struct import unpack
+from threading import local, Thread, Lock
+from collections import deque
+from time import monotonic, time
+from io import SEEK_SET, SEEK_CUR, SEEK_END
 import sys
 
-from django.db import models
+from django.db import models, transaction, connection
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.core.signals import request_started
+from django.dispatch import receiver
+from django.conf import settings
 from django.db.models.aggregates import Count
+from django.db.models import F
+from django.db.models.functions import Concat, Substr, Lower
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from lucterios.framework.models import LucteriosModel, LucteriosVirtualField, PrintFieldsPlugIn, LucteriosQuerySet
-from lucterios.framework.filetools import get_user_path, remove_accent, BASE64_PREFIX, readimage_to_base64
+from lucterios.framework.filetools import remove_accent, BASE64_PREFIX
 from lucterios.framework.signal_and_lock import Signal
 from lucterios.framework.auditlog import auditlog
+from lucterios.framework.error import LucteriosException, IMPORTANT
 from lucterios.framework.tools import get_binay, get_url_from_request, get_date_formating, toHtml
 
 from lucterios.CORE.models import LucteriosGroup, LucteriosUser, Parameter
 
 from lucterios.documents.models_legacy import Folder, Document
+from lucterios.documents.storage import get_storage
+from lucterios.documents.thumbnails import ThumbnailQueue, MINIATURE_BUILDERS, MINIATURE_HEIGHT, MINIATURE_HEIGHTS, MINIATURE_CONTENT_TYPES, \
+    get_thumbnails_config, get_miniature_version
 from lucterios.documents.doc_editors import DocEditor
 
 
+COMPRESSION_METHODS = {'stored': ZIP_STORED, 'deflated': ZIP_DEFLATED, 'bzip2': ZIP_BZIP2, 'lzma': ZIP_LZMA}
+
+DEFAULT_COMPRESSION = {
+    'default': ('deflated', 6),
+    'text': ('deflated', 9),
+    'stored_mimetypes': ('image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/avif', 'image/heic', 'image/tiff',
+                         'video/', 'audio/', 'application/pdf', 'application/zip', 'application/gzip', 'application/x-gzip',
+                         'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed', 'application/x-rar',
+                         'application/x-rar-compressed', 'application/zstd', 'application/epub+zip',
+                         'application/vnd.openxmlformats-officedocument.', 'application/vnd.oasis.opendocument.'),
+    'text_mimetypes': ('text/', 'application/json', 'application/xml', 'application/javascript', 'image/svg+xml'),
+}
+
+
+MIMETYPE_ICONS = (
+    (('image/svg+xml',), "mdi:mdi-file-chart-outline"),
+    (('image/',), "mdi:mdi-image-outline"),
+    (('text/',), "mdi:mdi-text-box-outline"),
+    (('application/pdf',), "mdi:mdi-file-pdf-box"),
+    (('application/vnd.ms-excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.'), "mdi:mdi-file-excel-outline"),
+    (('application/msword', 'application/vnd.openxmlformats-officedocument.wordprocessingml.'), "mdi:mdi-file-word-outline"),
+    (('application/vnd.ms-powerpoint', 'application/vnd.openxmlformats-officedocument.presentationml.'), "mdi:mdi-file-powerpoint-outline"),
+    (('application/vnd.oasis.opendocument.',), "mdi:mdi-file-document"),
+)
+
+
+def get_mimetype(buffer):
+    import magic
+    return magic.from_buffer(buffer, mime=True)
+
+
+def get_compression(mime_type):
+    policy = dict(DEFAULT_COMPRESSION)
+    policy.update(getattr(settings, 'DOCUMENTS_COMPRESSION', {}))
+    if mime_type.startswith(tuple(policy['stored_mimetypes'])):
+        method, level = 'stored', None
+    elif mime_type.startswith(tuple(policy['text_mimetypes'])):
+        method, level = policy['text']
+    else:
+        method, level = policy['default']
+    return COMPRESSION_METHODS[method], level
+
+
+class ContainerWindow(object):
+    # read-only file object limited to the raw bytes of a stored (not compressed) zip member
+    # the descriptor is used directly: its OS position is the one read by sendfile
+
+    def __init__(self, container_file, offset, size):
+        self.container_file = container_file
+        self.offset = offset
+        self.size = size
+        self.position = 0
+        self.seek(0)
+
+    def restrict(self, start, end):
+        self.offset += start
+        self.size = max(min(end + 1, self.size) - start, 0)
+        self.seek(0)
+
+    def fileno(self):
+        return self.container_file.fileno()
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self.position
+        elif whence == SEEK_END:
+            offset += self.size
+        self.position = min(max(offset, 0), self.size)
+        lseek(self.fileno(), self.offset + self.position, SEEK_SET)
+        return self.position
+
+    def read(self, size=-1):
+        if (size is None) or (size < 0) or (size > self.size - self.position):
+            size = self.size - self.position
+        data = b''
+        while len(data) < size:
+            chunk = os_read(self.fileno(), size - len(data))
+            if chunk == b'':
+                break
+            data += chunk
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.container_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_container_window(container_file):
+    with ZipFile(container_file, 'r') as zip_ref:
+        file_list = zip_ref.infolist()
+    if (len(file_list) == 0) or (file_list[0].compress_type != ZIP_STORED) or (file_list[0].flag_bits & 0x1):
+        return None
+    container_file.seek(file_list[0].header_offset)
+    header = container_file.read(30)
+    if (len(header) != 30) or (header[0:4] != b'PK\x03\x04'):
+        return None
+    name_length, extra_length = unpack('<HH', header[26:30])
+    return ContainerWindow(container_file, file_list[0].header_offset + 30 + name_length + extra_length, file_list[0].file_size)
+
+
+def iter_container(container_file, chunk_size):
+    with ZipFile(container_file, 'r') as zip_ref:
+        file_list = zip_ref.namelist()
+        if len(file_list) > 0:
+            with zip_ref.open(file_list[0]) as doc_file:
+                chunk = doc_file.read(chunk_size)
+                while chunk != b'':
+                    yield chunk
+                    chunk = doc_file.read(chunk_size)
+
+
+def get_container_head(container_file, size=2048):
+    head = b''
+    for chunk in iter_container(container_file, size):
+        head += chunk
+        if len(head) >= size:
+            break
+    return head[:size]
+
+
+def get_extract_name(name):
+    # names are free text: only their last component is used as file name
+    extract_name = basename(name.replace('\\', '/'))
+    return extract_name if extract_name not in ('', '.', '..') else '_'
+
+
+def get_container_size(container_file):
+    # read from the zip central directory, without decompressing
+    with ZipFile(container_file, 'r') as zip_ref:
+        file_infos = zip_ref.infolist()
+        return file_infos[0].file_size if len(file_infos) > 0 else 0
+
+
+def copy_content(source, target, chunk_size, head=b''):
+    # size and checksum computed while writing, without reading the container back
+    content_hash = sha256(head)
+    content_size = len(head)
+    target.write(head)
+    chunk = source.read(chunk_size)
+    while chunk:
+        content_hash.update(chunk)
+        content_size += len(chunk)
+        target.write(chunk)
+        chunk = source.read(chunk_size)
+    return content_size, content_hash.hexdigest()
+
+
+def get_container_info(container_file, chunk_size):
+    content_hash = sha256()
+    content_size = 0
+    for chunk in iter_container(container_file, chunk_size):
+        content_hash.update(chunk)
+        content_size += len(chunk)
+    return content_size, content_hash.hexdigest()
+
+
+class PermissionResolver(object):
+    # per-request cache of the folders a user can view or modify
+
+    _cache = local()
+
+    def __init__(self, user):
+        self.user = user
+        self._group_ids = None
+        self.viewable = set()
+        self.modifiable = set()
+        self.loaded = set()
+
+    @classmethod
+    def get(cls, user):
+        resolvers = getattr(cls._cache, 'resolvers', None)
+        if resolvers is None:
+            resolvers = {}
+            cls._cache.resolvers = resolvers
+        user_key = (user.id, user.is_superuser)
+        if user_key not in resolvers:
+            resolvers[user_key] = cls(user)
+        return resolvers[user_key]
+
+    @classmethod
+    def clear(cls, *args, **kwargs):
+        cls._cache.resolvers = {}
+
+    @property
+    def group_ids(self):
+        if self._group_ids is None:
+            self._group_ids = set(self.user.groups.values_list('id', flat=True)) if self.user.id is not None else set()
+        return self._group_ids
+
+    def load(self, folder_ids):
+        folder_ids = set(folder_ids) - self.loaded
+        if self.user.is_superuser or (len(folder_ids) == 0):
+            return
+        self.loaded |= folder_ids
+        if len(self.group_ids) > 0:
+            for folder_id, can_view, can_modify in FolderPermission.objects.filter(folder_id__in=folder_ids, group_id__in=self.group_ids).values_list('folder_id', 'can_view', 'can_modify'):
+                if can_view:
+                    self.viewable.add(folder_id)
+                if can_modify:
+                    self.modifiable.add(folder_id)
+
+    def can_view(self, folder_id):
+        if self.user.is_superuser:
+            return True
+        self.load([folder_id])
+        return folder_id in self.viewable
+
+    def can_modify(self, folder_id):
+        if self.user.is_superuser:
+            return True
+        self.load([folder_id])
+        return folder_id in self.modifiable
+
+
+class FolderTitleCache(object):
+    # per-request cache of folder id -> (name, path), filled with the ancestors of the folders asked for
+
+    _cache = local()
+
+    @classmethod
+    def get_folders(cls):
+        folders = getattr(cls._cache, 'folders', None)
+        if folders is None:
+            folders = {}
+            cls._cache.folders = folders
+        return folders
+
+    @classmethod
+    def load_folders(cls, folder_ids):
+        folders = cls.get_folders()
+        missing_ids = [folder_id for folder_id in folder_ids if folder_id not in folders]
+        if len(missing_ids) > 0:
+            for folder_id, name, path in FolderContainer.objects.filter(id__in=missing_ids).values_list('id', 'name', 'path'):
+                folders[folder_id] = (name, path)
+        return folders
+
+    @classmethod
+    def clear(cls, *args, **kwargs):
+        cls._cache.folders = None
+
+    @classmethod
+    def get_title(cls, folder_id, last_name=None, path=None):
+        if path is None:
+            folder = cls.load_folders([folder_id]).get(folder_id)
+            path = folder[1] if folder is not None else None
+        if path is None:
+            return None
+        title = ""
+        path_ids = [int(path_id) for path_id in path.strip('/').split('/')]
+        folders = cls.load_folders(path_ids)
+        for path_id in path_ids:
+            if path_id not in folders:
+                return "---"
+            title += ">" + (folders[path_id][0] if (path_id != folder_id) or (last_name is None) else last_name)
+        return title
+
+
 class AbstractContainer(LucteriosModel):
 
     parent = models.ForeignKey('FolderContainer', verbose_name=_('parent'), null=True, on_delete=models.CASCADE)
@@ -102,11 +391,15 @@ class AbstractContainer(LucteriosModel):
         verbose_name_plural = _('containers')
         default_permissions = []
         ordering = ['-foldercontainer', 'parent__name', 'name']
+        indexes = [models.Index(F('parent'), Lower('name'), F('id'), name='documents_container_keyset'),
+                   models.Index(fields=['parent', 'name'], name='documents_container_parent'),
+                   models.Index(fields=['name', 'parent'], name='documents_container_name')]
 
 
 class FolderContainer(AbstractContainer):
     viewer = models.ManyToManyField(LucteriosGroup, related_name="foldercontainer_viewer", verbose_name=_('viewer'), blank=True)
     modifier = models.ManyToManyField(LucteriosGroup, related_name="foldercontainer_modifier", verbose_name=_('modifier'), blank=True)
+    path = models.CharField('path', max_length=500, null=True, db_index=True)
 
     BAD_RECURSIVE = " !! "
     MAX_RECURSIVE = 10
@@ -142,7 +435,15 @@ class FolderContainer(AbstractContainer):
     def get_default_fields(cls):
         return ["name", "description", "parent"]
 
+    @property
+    def path_ids(self):
+        return [int(folder_id) for folder_id in self.path.strip('/').split('/')]
+
     def get_title(self, num=0):
+        if self.path is not None:
+            title = FolderTitleCache.get_title(self.id, self.name, self.path)
+            if title is not None:
+                return title
         try:
             title = ">" + self.name
             if self.parent_id is not None:
@@ -158,53 +459,157 @@ class FolderContainer(AbstractContainer):
         return self.get_title()
 
     def is_readonly(self, user):
-        if user.is_superuser:
-            return False
-        readonly = True
-        for modifier_item in self.modifier.all():
-            if modifier_item in user.groups.all():
-                readonly = False
-        return readonly
+        return not PermissionResolver.get(user).can_modify(self.id)
 
     def cannot_view(self, user):
-        if user.is_superuser:
-            return False
-        cannotview = True
-        for viewer_item in self.viewer.all():
-            if viewer_item in user.groups.all():
-                cannotview = False
-        return cannotview
+        return not PermissionResolver.get(user).can_view(self.id)
+
+    def get_descendant_folders(self):
+        if self.id is None:
+            return FolderContainer.objects.all()
+        return FolderContainer.objects.filter(path__startswith=self.path).exclude(id=self.id)
+
+    def get_subdocuments(self):
+        if self.id is None:
+            return DocumentContainer.objects.all()
+        return DocumentContainer.objects.filter(parent__path__startswith=self.path)
 
     def get_subfiles(self):
         file_paths = []
         if self.id is not None:
-            for container in self.abstractcontainer_set.all():
-                container = container.get_final_child()
-                if isinstance(container, DocumentContainer):
-                    file_paths.append(container.file_path)
-                else:
-                    file_paths.extend(container.get_subfiles())
+            for doc in self.get_subdocuments():
+                file_paths.append(doc.file_path)
         return file_paths
 
     def get_subfolders(self, user, wantmodify):
         items = FolderContainer.objects.filter(models.Q(parent=self if self.id is not None else None))
         if notfree_mode_connect() and not user.is_superuser:
+            resolver = PermissionResolver.get(user)
+            items = list(items)
+            resolver.load([item.id for item in items])
             new_items = []
             for item in items:
-                if not item.cannot_view(user):
-                    if wantmodify and not item.is_readonly(user):
+                if resolver.can_view(item.id):
+                    if wantmodify and resolver.can_modify(item.id):
                         new_items.append(item)
                     elif not wantmodify:
                         new_items.append(item)
             items = LucteriosQuerySet(model=FolderContainer, initial=new_items)
         return items
 
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        parent_path = "/"
+        if self.parent_id is not None:
+            parent_path = FolderContainer.objects.filter(id=self.parent_id).values_list('path', flat=True).first()
+            if parent_path is None:
+                parent_path = self.parent.get_path()
+            if (self.id is not None) and (("/%d/" % self.id) in parent_path):
+                raise LucteriosException(IMPORTANT, _("A folder can not be moved into itself or one of its sub-folders!"))
+        old_path = None
+        if self.id is not None:
+            old_path = FolderContainer.objects.filter(id=self.id).values_list('path', flat=True).first()
+            self.path = "%s%d/" % (parent_path, self.id)
+        res = AbstractContainer.save(self, force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        self.path = "%s%d/" % (parent_path, self.id)
+        if self.path != old_path:
+            FolderContainer.objects.filter(id=self.id).update(path=self.path)
+            if old_path is not None:
+                FolderContainer.objects.filter(path__startswith=old_path).exclude(id=self.id).update(path=Concat(models.Value(self.path), Substr('path', len(old_path) + 1)))
+        FolderTitleCache.clear()
+        return res
+
+    def get_path(self):
+        if self.path is None:
+            self.save()
+        return self.path
+
+    @classmethod
+    def rebuild_paths(cls):
+        # also copied, frozen, in migration 0010_foldercontainer_path
+        parents = dict(cls.objects.values_list('id', 'parent_id'))
+        paths = {}
+        for folder_id in parents.keys():
+            while folder_id not in paths:
+                ancestors = [folder_id]
+                current_id = parents[folder_id]
+                while (current_id is not None) and (current_id not in paths) and (current_id not in ancestors):
+                    ancestors.append(current_id)
+                    current_id = parents.get(current_id)
+                if current_id in ancestors:
+                    parents[current_id] = None
+                    AbstractContainer.objects.filter(id=current_id).update(parent=None)
+                    continue
+                parent_path = paths[current_id] if current_id is not None else "/"
+                for ancestor_id in reversed(ancestors):
+                    paths[ancestor_id] = "%s%d/" % (parent_path, ancestor_id)
+                    parent_path = paths[ancestor_id]
+        for folder_id, folder_path in cls.objects.values_list('id', 'path'):
+            if paths[folder_id] != folder_path:
+                cls.objects.filter(id=folder_id).update(path=paths[folder_id])
+        FolderTitleCache.clear()
+
+    DELETE_BATCH_SIZE = 500
+
     def delete(self):
-        sub_containers = list(self.abstractcontainer_set.all())
-        for sub_container in sub_containers:
-            sub_container = sub_container.get_final_child()
-            sub_container.delete()
-        LucteriosModel.delete(self)
+        logger = getLogger("lucterios.documents")
+        doc_items = list(self.get_subdocuments().order_by('id').values_list('id', 'checksum'))
+        for batch_index in range(0, len(doc_items), self.DELETE_BATCH_SIZE):
+            batch_items = doc_items[batch_index:batch_index + self.DELETE_BATCH_SIZE]
+            # bounded queries; within a request (ATOMIC_REQUESTS) each batch is only a savepoint of its transaction
+            with transaction.atomic():
+                DocumentContainer.objects.filter(id__in=[doc_id for doc_id, _checksum in batch_items]).delete()
+                checksums = set([checksum for _doc_id, checksum in batch_items if checksum is not None])
+                checksums -= set(DocumentContainer.objects.filter(checksum__in=checksums).values_list('checksum', flat=True))
+                released_at = time()
+                transaction.on_commit(lambda batch_items=batch_items, checksums=checksums, released_at=released_at: FolderContainer.start_purge(batch_items, checksums, released_at))
+            logger.info('delete folder %s: %d/%d documents', self.id, batch_index + len(batch_items), len(doc_items))
+        with transaction.atomic():
+            self.get_descendant_folders().delete()
+            LucteriosModel.delete(self)
+
+    _purge_lock = Lock()
+    _purge_jobs = deque()
+    _purge_worker = None
+
+    @classmethod
+    def start_purge(cls, doc_items, checksums, released_at=None):
+        if not getattr(settings, 'DOCUMENTS_PURGE_THREADED', True):
+            DocumentContainer.purge_files(doc_items, checksums, released_at)
+            return
+        with cls._purge_lock:
+            cls._purge_jobs.append((doc_items, checksums, released_at))
+            if cls._purge_worker is None:
+                # a single worker for all the batches, not a daemon: pending purges end before the interpreter exits
+                cls._purge_worker = Thread(target=cls._run_purge)
+                cls._purge_worker.start()
+
+    @classmethod
+    def _run_purge(cls):
+        try:
+            while True:
+                with cls._purge_lock:
+                    if len(cls._purge_jobs) == 0:
+                        cls._purge_worker = None
+                        return
+                    doc_items, checksums, released_at = cls._purge_jobs.popleft()
+                try:
+                    DocumentContainer.purge_files(doc_items, checksums, released_at)
+                except Exception as err:
+                    getLogger("lucterios.documents").warning('purge files failed: %s', err)
+        finally:
+            connection.close()
+
+    @classmethod
+    def wait_purge(cls, timeout=None):
+        end_time = None if timeout is None else monotonic() + timeout
+        while True:
+            with cls._purge_lock:
+                purge_worker = cls._purge_worker
+            if purge_worker is None:
+                return True
+            if (end_time is not None) and (monotonic() > end_time):
+                return False
+            purge_worker.join(None if end_time is None else max(end_time - monotonic(), 0))
 
     def import_files(self, dir_to_import, viewers, modifiers, user):
         for filename in listdir(dir_to_import):
@@ -227,18 +632,27 @@ class FolderContainer(AbstractContainer):
                 new_folder.import_files(complet_path, viewers, modifiers, user)
 
     def extract_files(self, dir_to_extract):
-        for doc in DocumentContainer.objects.filter(parent_id=self.id):
-            if isfile(doc.file_path):
+        root_depth = len(self.path_ids) if self.id is not None else 0
+        names = {}
+        folder_dirs = {self.id: dir_to_extract}
+        extract_root = realpath(dir_to_extract)
+        for folder in self.get_descendant_folders().order_by('path'):
+            names[folder.id] = get_extract_name(folder.name)
+            folder_dirs[folder.id] = join(dir_to_extract, *[names.get(folder_id, '') for folder_id in folder.path_ids[root_depth:]])
+            if not isdir(folder_dirs[folder.id]):
+                makedirs(folder_dirs[folder.id])
+        for doc in self.get_subdocuments():
+            if not doc.isempty and (doc.parent_id in folder_dirs):
+                file_path = join(folder_dirs[doc.parent_id], get_extract_name(doc.name))
+                if not realpath(file_path).startswith(extract_root + sep):
+                    getLogger("lucterios.documents").warning('extract_files: document %s out of %s', doc.id, dir_to_extract)
+                    continue
                 try:
-                    with ZipFile(doc.file_path, 'r') as zip_ref:
-                        zip_ref.extractall(dir_to_extract)
-                except BadZipFile:
-                    pass
-        for folder in FolderContainer.objects.filter(parent_id=self.id):
-            new_dir_to_extract = join(dir_to_extract, folder.name)
-            if not isdir(new_dir_to_extract):
-                makedirs(new_dir_to_extract)
-            folder.extract_files(new_dir_to_extract)
+                    with open(file_path, 'wb') as file_extract:
+                        for chunk in doc.iter_content():
+                            file_extract.write(chunk)
+                except (BadZipFile, OSError) as err:
+                    getLogger("lucterios.documents").warning('extract_files: document %s not extracted: %s', doc.id, err)
 
     def add_pdf_document(self, title, user, metadata, pdf_content):
         new_doc = DocumentContainer.objects.create(name=remove_accent('%s.pdf' % title), description=title.replace('_', ' '), parent=self,
@@ -254,9 +668,37 @@ class FolderContainer(AbstractContainer):
         ordering = ['parent__name', 'name']
 
 
+class FolderPermission(LucteriosModel):
+    folder = models.ForeignKey(FolderContainer, verbose_name=_('folder'), related_name='permissions', null=False, on_delete=models.CASCADE)
+    group = models.ForeignKey(LucteriosGroup, verbose_name=_('group'), related_name='+', null=False, on_delete=models.CASCADE)
+    can_view = models.BooleanField(verbose_name=_('viewer'), default=False)
+    can_modify = models.BooleanField(verbose_name=_('modifier'), default=False)
+
+    @classmethod
+    def refresh(cls, folder_ids):
+        folder_ids = list(folder_ids)
+        viewers = set(FolderContainer.viewer.through.objects.filter(foldercontainer_id__in=folder_ids).values_list('foldercontainer_id', 'lucteriosgroup_id'))
+        modifiers = set(FolderContainer.modifier.through.objects.filter(foldercontainer_id__in=folder_ids).values_list('foldercontainer_id', 'lucteriosgroup_id'))
+        cls.objects.filter(folder_id__in=folder_ids).delete()
+        cls.objects.bulk_create([cls(folder_id=folder_id, group_id=group_id, can_view=(folder_id, group_id) in viewers, can_modify=(folder_id, group_id) in modifiers)
+                                 for folder_id, group_id in viewers | modifiers])
+
+    @classmethod
+    def viewable_folders(cls, user):
+        return cls.objects.filter(group_id__in=PermissionResolver.get(user).group_ids, can_view=True).values('folder_id')
+
+    class Meta(object):
+        verbose_name = _('folder permission')
+        verbose_name_plural = _('folder permissions')
+        default_permissions = []
+        unique_together = (('folder', 'group'),)
+        indexes = [models.Index(fields=['group', 'can_view', 'folder'], name='documents_folderperm_view')]
+
+
 class DocumentContainer(AbstractContainer):
 
-    MINIATURE_HEIGHT = 200
+    MINIATURE_HEIGHT = MINIATURE_HEIGHT
+    CHUNK_SIZE = 64 * 1024
 
     modifier = models.ForeignKey(LucteriosUser, related_name="documentcontainer_modifier",
                                  verbose_name=_('modifier'), null=True, on_delete=models.CASCADE)
@@ -266,6 +708,10 @@ class DocumentContainer(AbstractContainer):
     date_creation = models.DateTimeField(verbose_name=_('date creation'), null=False)
     sharekey = models.CharField('sharekey', max_length=100, null=True)
     metadata = models.CharField('metadata', max_length=200, null=True)
+    size = models.BigIntegerField('size', null=True)
+    compressed_size = models.BigIntegerField('compressed size', null=True)
+    checksum = models.CharField('checksum', max_length=64, null=True, db_index=True)
+    mimetype = models.CharField('mimetype', max_length=100, null=True)
 
     @classmethod
     def get_popper_path(cls):
@@ -321,92 +767,173 @@ class DocumentContainer(AbstractContainer):
         self.filter = models.Q()
         self.shared_link = None
         self.root_url = None
+        self.miniature_inline = True
+        self.miniature_height = self.MINIATURE_HEIGHT
 
     def __str__(self):
+        if self.parent_id is not None:
+            parent_title = FolderTitleCache.get_title(self.parent_id)
+            if parent_title is not None:
+                return '[%s] %s' % (parent_title, self.name)
         return '[%s] %s' % (self.parent, self.name)
 
+    @property
+    def storage_name(self):
+        if self.checksum is not None:
+            return self.get_blob_name(self.checksum)
+        return self.legacy_name
+
+    @property
+    def legacy_name(self):
+        return "container_%s" % str(self.id)
+
+    @property
+    def miniature_key(self):
+        return "miniature_%s" % str(self.id)
+
+    @property
+    def miniature_format(self):
+        return get_thumbnails_config()['format']
+
+    def get_miniature_name(self, height=None, image_format=None):
+        return "%s_%d.%s" % (self.miniature_key, height if height is not None else self.miniature_height,
+                             image_format if image_format is not None else self.miniature_format)
+
+    @property
+    def miniature_name(self):
+        return self.get_miniature_name()
+
+    @property
+    def miniature_names(self):
+        miniature_names = ["%s.png" % self.miniature_key]
+        for image_format in MINIATURE_CONTENT_TYPES.keys():
+            miniature_names.extend([self.get_miniature_name(height, image_format) for height in MINIATURE_HEIGHTS])
+        return miniature_names
+
     @property
     def file_path(self):
-        return get_user_path("documents", "container_%s" % str(self.id))
+        return get_storage().path(self.storage_name)
 
     @property
     def miniature_path(self):
-        return get_user_path("documents", "miniature_%s.png" % str(self.id))
+        return get_storage().path(self.miniature_name)
+
+    def open_stored_content(self, start=0, end=None):
+        storage = get_storage()
+        if storage.exists(self.storage_name):
+            container_file = storage.open(self.storage_name)
+            try:
+                window = open_container_window(container_file)
+            except BadZipFile:
+                window = None
+            if window is not None:
+                if (start > 0) or (end is not None):
+                    window.restrict(start, window.size - 1 if end is None else end)
+                return window
+            container_file.close()
+        return None
+
+    @property
+    def compress_type(self):
+        storage = get_storage()
+        if storage.exists(self.storage_name):
+            with storage.open(self.storage_name) as container_file:
+                with ZipFile(container_file, 'r') as zip_ref:
+                    file_list = zip_ref.infolist()
+                    if len(file_list) > 0:
+                        return file_list[0].compress_type
+        return None
+
+    def refresh_mimetype(self):
+        storage = get_storage()
+        self.mimetype = None
+        if storage.exists(self.storage_name):
+            try:
+                with storage.open(self.storage_name) as container_file:
+                    self.mimetype = get_mimetype(get_container_head(container_file))
+            except BadZipFile:
+                getLogger("lucterios.documents").warning('refresh_mimetype: bad container for document %s', self.id)
+        if self.id is not None:
+            DocumentContainer.objects.filter(id=self.id).update(mimetype=self.mimetype)
+        return self.mimetype
 
     @property
     def mimetypevalue(self):
-        import magic
-        if not hasattr(self, '_mimetypevalue'):
-            self._mimetypevalue = magic.from_buffer(self.content.read(2048))
-        return self._mimetypevalue
-
-    def _resize_miniature(self, image):
-        original_width, original_height = image.size
-        miniature_width = original_width * self.MINIATURE_HEIGHT / original_height
-        image = image.resize((int(miniature_width), self.MINIATURE_HEIGHT))
-        image = image.convert("RGB")
-        with open(self.miniature_path, "wb") as image_file:
-            image.save(image_file, 'PNG', quality=90)
-
-    def _create_miniature_image_outline(self):
-        from PIL import Image
-        image = Image.open(self.content)
-        self._resize_miniature(image)
-        return isfile(self.miniature_path)
-
-    def _create_miniature_file_chart_outline(self):
-        from cairosvg import svg2png
-        with open(self.miniature_path, 'wb') as png_file:
-            svg2png(file_obj=self.content, write_to=png_file, output_height=self.MINIATURE_HEIGHT)
-        return isfile(self.miniature_path)
-
-    def _create_miniature_file_pdf_box(self):
-        # Download "pdfinfo" : https://www.xpdfreader.com/download.html (Xpdf command line tools)
-        from pdf2image import convert_from_bytes
-        images_list = convert_from_bytes(self.content.read(), first_page=0, last_page=1, poppler_path=self.get_popper_path())
-        if len(images_list) > 0:
-            self._resize_miniature(images_list[0])
-        return isfile(self.miniature_path)
+        if (self.mimetype is None) and not self.isempty:
+            self.refresh_mimetype()
+        return self.mimetype if self.mimetype is not None else ''
+
+    def get_mimetype_icon(self):
+        mime_type = self.mimetypevalue
+        for mime_prefixes, image_to_show in MIMETYPE_ICONS:
+            if mime_type.startswith(mime_prefixes):
+                return image_to_show
+        return None
+
+    def get_miniature_request(self, image_to_show=None):
+        if image_to_show is None:
+            image_to_show = self.get_mimetype_icon()
+        miniature_kind = image_to_show[8:].replace('-', '_') if image_to_show is not None else None
+        if (miniature_kind in MINIATURE_BUILDERS) and not self.isempty:
+            renditions = {self.get_miniature_name(height): height for height in MINIATURE_HEIGHTS}
+            return self.file_path, miniature_kind, renditions, self.get_popper_path()
+        return None
+
+    def generate_miniature(self, image_to_show=None):
+        miniature_request = self.get_miniature_request(image_to_show)
+        if miniature_request is not None:
+            return ThumbnailQueue.submit(self.miniature_key, *miniature_request)
+        return False
+
+    @classmethod
+    def missing_miniatures(cls, folder=None):
+        storage = get_storage()
+        doc_query = folder.get_subdocuments() if folder is not None else cls.objects.all()
+        for doc in doc_query.order_by('id').iterator():
+            if not storage.exists(doc.miniature_name):
+                miniature_request = doc.get_miniature_request()
+                if miniature_request is not None:
+                    yield doc, miniature_request
+
+    def _reset_miniature(self):
+        ThumbnailQueue.cancel(self.miniature_key)
+        storage = get_storage()
+        for miniature_name in self.miniature_names:
+            storage.delete(miniature_name)
+        if self.id is not None:
+            transaction.on_commit(self.generate_miniature)
+
+    def get_miniature_base64(self):
+        with get_storage().open(self.miniature_name) as image_file:
+            return BASE64_PREFIX.replace('*', self.miniature_format) + b64encode(image_file.read()).decode()
+
+    def get_miniature_url(self, miniature_stat):
+        return "%s/lucterios.documents/files/%d/miniature?size=%d&v=%s" % (self.root_url, self.id, self.miniature_height, get_miniature_version(miniature_stat))
 
     def get_image(self):
-        if isfile(self.miniature_path):
-            return readimage_to_base64(self.miniature_path).decode()
-        image_to_show = None
-        if 'image' in self.mimetypevalue:
-            image_to_show = "mdi:mdi-image-outline"
-        if 'text' in self.mimetypevalue:
-            image_to_show = "mdi:mdi-text-box-outline"
-        if self.mimetypevalue.startswith('SVG'):
-            image_to_show = "mdi:mdi-file-chart-outline"
-        if self.mimetypevalue.startswith('PDF document'):
-            image_to_show = "mdi:mdi-file-pdf-box"
-        if self.mimetypevalue.startswith('Microsoft Excel'):
-            image_to_show = "mdi:mdi-file-excel-outline"
-        if self.mimetypevalue.startswith('Microsoft Word'):
-            image_to_show = "mdi:mdi-file-word-outline"
-        if self.mimetypevalue.startswith('Microsoft PowerPoint'):
-            image_to_show = "mdi:mdi-file-powerpoint-outline"
-        if self.mimetypevalue.startswith('OpenDocument'):
-            image_to_show = "mdi:mdi-file-document"
+        miniature_stat = get_storage().stat(self.miniature_name)
+        if miniature_stat is not None:
+            if self.miniature_inline or (self.root_url is None):
+                return self.get_miniature_base64()
+            return self.get_miniature_url(miniature_stat)
+        image_to_show = self.get_mimetype_icon()
         if image_to_show is not None:
-            convert_function = getattr(self, "_create_miniature_" + image_to_show[8:].replace('-', '_'), None)
-            if (convert_function is not None) and convert_function():
-                return readimage_to_base64(self.miniature_path).decode()
+            if self.generate_miniature(image_to_show) and get_storage().exists(self.miniature_name):
+                return self.get_miniature_base64()
             return image_to_show
         return AbstractContainer.get_image(self)
 
     def delete(self):
-        file_path = self.file_path
-        miniature_file_path = self.miniature_path
+        doc_items = [(self.id, self.checksum)]
+        ThumbnailQueue.cancel(self.miniature_key)
         LucteriosModel.delete(self)
-        if isfile(file_path):
-            unlink(file_path)
-        if isfile(miniature_file_path):
-            unlink(miniature_file_path)
+        released_at = time()
+        # files are only removed once the deletion is committed
+        transaction.on_commit(lambda: DocumentContainer.purge_files(doc_items, set([checksum for _doc_id, checksum in doc_items if checksum is not None]), released_at))
 
     def set_context(self, xfer):
         if notfree_mode_connect() and not isinstance(xfer, str) and not xfer.request.user.is_superuser:
-            self.filter = models.Q(parent=None) | models.Q(parent__viewer__in=xfer.request.user.groups.all())
+            self.filter = models.Q(parent=None) | models.Q(parent_id__in=FolderPermission.viewable_folders(xfer.request.user))
         if isinstance(xfer, str):
             self.root_url = xfer
         else:
@@ -423,38 +950,186 @@ class DocumentContainer(AbstractContainer):
 
     @property
     def isempty(self):
-        return not isfile(self.file_path)
+        return not get_storage().exists(self.storage_name)
 
     @property
     def content(self):
-        from _io import BytesIO
-        if isfile(self.file_path):
-            with ZipFile(self.file_path, 'r') as zip_ref:
-                file_list = zip_ref.namelist()
-                if len(file_list) > 0:
-                    doc_file = zip_ref.open(file_list[0])
-                    return BytesIO(doc_file.read())
+        storage = get_storage()
+        if storage.exists(self.storage_name):
+            with storage.open(self.storage_name) as container_file:
+                with ZipFile(container_file, 'r') as zip_ref:
+                    file_list = zip_ref.namelist()
+                    if len(file_list) > 0:
+                        doc_file = zip_ref.open(file_list[0])
+                        return BytesIO(doc_file.read())
         return BytesIO(b'')
 
+    def iter_content(self, chunk_size=None, start=0, end=None):
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+        storage = get_storage()
+        if storage.exists(self.storage_name):
+            with storage.open(self.storage_name) as container_file:
+                position = 0
+                for chunk in iter_container(container_file, chunk_size):
+                    chunk_start = position
+                    position += len(chunk)
+                    if position <= start:
+                        continue
+                    if (end is not None) and (chunk_start > end):
+                        break
+                    yield chunk[max(start - chunk_start, 0):None if end is None else end + 1 - chunk_start]
+
     @content.setter
     def content(self, content):
-        from _io import BytesIO
+        storage = get_storage()
         if (content == "") or (content == b""):
-            if isfile(self.file_path):
-                unlink(self.file_path)
-        elif not isinstance(content, BytesIO) and hasattr(content, 'read'):
-            with open(self.file_path, "wb") as file_tmp:
-                file_tmp.write(content.read())
+            self._store_container(None)
+        else:
+            tmp_path = storage.temp_path()
+            mime_type = None
+            content_info = None
+            try:
+                if not isinstance(content, BytesIO) and hasattr(content, 'read'):
+                    with open(tmp_path, "wb") as file_tmp:
+                        content_info = copy_content(content, file_tmp, self.CHUNK_SIZE)
+                    if is_zipfile(tmp_path):
+                        content_info = None
+                    else:
+                        raw_path = tmp_path + '.raw'
+                        rename(tmp_path, raw_path)
+                        try:
+                            with open(raw_path, 'rb') as raw_file:
+                                mime_type = get_mimetype(raw_file.read(2048))
+                            compress_type, compress_level = get_compression(mime_type)
+                            with ZipFile(tmp_path, 'w', compression=compress_type, compresslevel=compress_level) as zip_ref:
+                                zip_ref.write(raw_path, arcname=self.name)
+                        finally:
+                            unlink(raw_path)
+                else:
+                    if isinstance(content, BytesIO):
+                        content = content.read()
+                    if isinstance(content, str):
+                        content = content.encode()
+                    mime_type = get_mimetype(content[:2048])
+                    content_info = (len(content), sha256(content).hexdigest())
+                    compress_type, compress_level = get_compression(mime_type)
+                    with ZipFile(tmp_path, 'w', compression=compress_type, compresslevel=compress_level) as zip_ref:
+                        zip_ref.writestr(zinfo_or_arcname=self.name, data=content)
+                self._store_container(tmp_path, mime_type, content_info)
+            finally:
+                if isfile(tmp_path):
+                    unlink(tmp_path)
+        self._reset_miniature()
+
+    def upload_content(self, stream, head=None):
+        storage = get_storage()
+        if head is None:
+            head = stream.read(2048)
+        if (head is None) or (len(head) == 0):
+            self._store_container(None)
         else:
-            with ZipFile(self.file_path, 'w') as zip_ref:
-                if isinstance(content, BytesIO):
-                    content = content.read()
-                if isinstance(content, str):
-                    content = content.encode()
-                if isinstance(content, bytes):
-                    zip_ref.writestr(zinfo_or_arcname=self.name, data=content)
-        if isfile(self.miniature_path):
-            unlink(self.miniature_path)
+            tmp_path = storage.temp_path()
+            try:
+                mime_type = get_mimetype(head)
+                compress_type, compress_level = get_compression(mime_type)
+                with ZipFile(tmp_path, 'w', compression=compress_type, compresslevel=compress_level) as zip_ref:
+                    with zip_ref.open(self.name, 'w', force_zip64=True) as doc_file:
+                        content_info = copy_content(stream, doc_file, self.CHUNK_SIZE, head)
+                self._store_container(tmp_path, mime_type, content_info)
+            finally:
+                if isfile(tmp_path):
+                    unlink(tmp_path)
+        self._reset_miniature()
+
+    def _store_container(self, tmp_path, mime_type=None, content_info=None):
+        storage = get_storage()
+        old_checksum = DocumentContainer.objects.filter(id=self.id).values_list('checksum', flat=True).first() if self.id is not None else self.checksum
+        if tmp_path is None:
+            self.size, self.compressed_size, self.checksum, self.mimetype = None, None, None, None
+        else:
+            self.size, self.checksum = content_info if content_info is not None else get_container_info(tmp_path, self.CHUNK_SIZE)
+            self.compressed_size = getsize(tmp_path)
+            self.mimetype = mime_type if mime_type is not None else get_mimetype(get_container_head(tmp_path))
+            blob_name = self.get_blob_name(self.checksum)
+            with storage.lock():
+                if not storage.exists(blob_name):
+                    storage.commit(blob_name, tmp_path)
+                # a newer mtime protects the blob against a release decided before this reuse
+                storage.touch(blob_name)
+        if self.id is not None:
+            DocumentContainer.objects.filter(id=self.id).update(size=self.size, compressed_size=self.compressed_size, checksum=self.checksum, mimetype=self.mimetype)
+        legacy_name = self.legacy_name
+        released_checksum = old_checksum if old_checksum != self.checksum else None
+        released_at = time()
+        transaction.on_commit(lambda: self.release_files(legacy_name, released_checksum, released_at))
+
+    @classmethod
+    def release_files(cls, legacy_name, checksum, released_at):
+        get_storage().delete(legacy_name)
+        cls.release_blob(checksum, released_at)
+
+    @property
+    def content_size(self):
+        if self.size is not None:
+            return self.size
+        storage = get_storage()
+        if storage.exists(self.storage_name):
+            try:
+                with storage.open(self.storage_name) as container_file:
+                    return get_container_size(container_file)
+            except BadZipFile:
+                pass
+        return 0
+
+    def refresh_file_info(self):
+        storage = get_storage()
+        if (self.checksum is None) and storage.exists(self.legacy_name):
+            tmp_path = storage.temp_path()
+            try:
+                with storage.open(self.legacy_name) as container_file:
+                    with open(tmp_path, "wb") as file_tmp:
+                        copyfileobj(container_file, file_tmp, self.CHUNK_SIZE)
+                self._store_container(tmp_path)
+                return True
+            except BadZipFile:
+                getLogger("lucterios.documents").warning('refresh_file_info: bad container for document %s', self.id)
+            finally:
+                if isfile(tmp_path):
+                    unlink(tmp_path)
+        return False
+
+    @classmethod
+    def get_blob_name(cls, checksum):
+        return "blob_%s" % checksum
+
+    @classmethod
+    def purge_files(cls, doc_items, checksums, released_at=None):
+        storage = get_storage()
+        for doc_id, _checksum in doc_items:
+            doc = cls(id=doc_id)
+            ThumbnailQueue.cancel(doc.miniature_key)
+            storage.delete(doc.legacy_name)
+            for miniature_name in doc.miniature_names:
+                storage.delete(miniature_name)
+        for checksum in checksums:
+            # a document may have referenced this blob again since the batch was deleted
+            cls.release_blob(checksum, released_at)
+        getLogger("lucterios.documents").info('purge files: documents=%d blobs=%d', len(doc_items), len(checksums))
+
+    @classmethod
+    def release_blob(cls, checksum, released_at=None):
+        if checksum is None:
+            return
+        storage = get_storage()
+        blob_name = cls.get_blob_name(checksum)
+        with storage.lock():
+            if cls.objects.filter(checksum=checksum).exists():
+                return
+            blob_stat = storage.stat(blob_name)
+            # touched since the release: reused by a document not committed yet
+            if (blob_stat is not None) and ((released_at is None) or (blob_stat.st_mtime <= released_at)):
+                storage.delete(blob_name)
 
     def change_sharekey(self, clear):
         if clear:
@@ -479,6 +1154,8 @@ class DocumentContainer(AbstractContainer):
         verbose_name_plural = _('documents')
         default_permissions = []
         ordering = ['parent__name', 'name']
+        indexes = [models.Index(fields=['date_modification', 'modifier'], name='documents_document_modif')]
+        constraints = [models.UniqueConstraint(fields=['sharekey'], condition=models.Q(sharekey__isnull=False), name='documents_document_sharekey')]
 
 
 def migrate_containers(old_parent, new_parent):
@@ -533,6 +1210,19 @@ def merge_multicontainers():
         getLogger("lucterios.documents").info('Merge multi-containers: folder=%d - documents=%d', nb_folder, nb_doc)
 
 
+def refresh_legacy_containers(batch_size=500):
+    # backfill of the file info for containers stored before the checksums (see also documents_fileinfo)
+    doc_ids = list(DocumentContainer.objects.filter(checksum__isnull=True).order_by('id').values_list('id', flat=True))
+    nb_doc = 0
+    for batch_index in range(0, len(doc_ids), batch_size):
+        for doc in DocumentContainer.objects.filter(id__in=doc_ids[batch_index:batch_index + batch_size]).order_by('id'):
+            if doc.refresh_file_info():
+                nb_doc += 1
+    if nb_doc > 0:
+        getLogger("lucterios.documents").info('Refresh legacy containers: documents=%d', nb_doc)
+    return nb_doc
+
+
 class DefaultDocumentsPrintPlugin(PrintFieldsPlugIn):
 
     name = "DEFAULT_DOCUMENTS"
@@ -564,10 +1254,35 @@ PrintFieldsPlugIn.add_plugin(DefaultDocumentsPrintPlugin)
 
 
 def check_parent_folder():
-    for folder in FolderContainer.objects.all():
-        if folder.get_title().startswith(FolderContainer.BAD_RECURSIVE):
-            folder.parent = None
-            folder.save()
+    FolderContainer.rebuild_paths()
+
+
+@receiver(m2m_changed, sender=FolderContainer.viewer.through)
+@receiver(m2m_changed, sender=FolderContainer.modifier.through)
+def documents_folder_permission_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            FolderPermission.refresh([instance.id])
+        elif pk_set is not None:
+            FolderPermission.refresh(pk_set)
+        else:
+            FolderPermission.refresh(FolderPermission.objects.filter(group_id=instance.id).values_list('folder_id', flat=True))
+
+
+@receiver(request_started)
+@receiver(post_save, sender=FolderContainer)
+@receiver(post_delete, sender=FolderContainer)
+def documents_folder_changed(*args, **kwargs):
+    FolderTitleCache.clear()
+
+
+@receiver(request_started)
+@receiver(m2m_changed, sender=FolderContainer.viewer.through)
+@receiver(m2m_changed, sender=FolderContainer.modifier.through)
+@receiver(m2m_changed, sender=LucteriosUser.groups.through)
+@receiver(post_delete, sender=FolderContainer)
+def documents_permission_changed(*args, **kwargs):
+    PermissionResolver.clear()
 
 
 @Signal.decorate('convertdata')
@@ -575,6 +1290,7 @@ def documents_convertdata():
     migrate_containers(None, None)
     merge_multicontainers()
     check_parent_folder()
+    refresh_legacy_containers()
 
 
 @Signal.decorate('checkparam')
@@ -23,16 +23,14 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
-from os import unlink
-from os.path import isfile
 from zipfile import ZipFile
 
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
 from lucterios.framework.models import LucteriosModel
-from lucterios.framework.filetools import get_user_path
 from lucterios.CORE.models import LucteriosGroup, LucteriosUser
+from lucterios.documents.storage import get_storage
 
 
 class Folder(LucteriosModel):
@@ -43,14 +41,14 @@ class Folder(LucteriosModel):
     modifier = models.ManyToManyField(LucteriosGroup, related_name="folder_modifier", verbose_name=_('modifier'), blank=True)
 
     def delete(self):
-        file_paths = []
+        file_names = []
         docs = self.document_set.all()
         for doc in docs:
-            file_paths.append(get_user_path("documents", "document_%s" % str(doc.id)))
+            file_names.append("document_%s" % str(doc.id))
         LucteriosModel.delete(self)
-        for file_path in file_paths:
-            if isfile(file_path):
-                unlink(file_path)
+        storage = get_storage()
+        for file_name in file_names:
+            storage.delete(file_name)
 
     # DEPRECATED MODEL
 
@@ -73,13 +71,15 @@ class Document(LucteriosModel):
     @property
     def content(self):
         from _io import BytesIO
-        file_path = get_user_path("documents", "document_%s" % str(self.id))
-        if isfile(file_path):
-            with ZipFile(file_path, 'r') as zip_ref:
-                file_list = zip_ref.namelist()
-                if len(file_list) > 0:
-                    doc_file = zip_ref.open(file_list[0])
-                    return BytesIO(doc_file.read())
+        file_name = "document_%s" % str(self.id)
+        storage = get_storage()
+        if storage.exists(file_name):
+            with storage.open(file_name) as container_file:
+                with ZipFile(container_file, 'r') as zip_ref:
+                    file_list = zip_ref.namelist()
+                    if len(file_list) > 0:
+                        doc_file = zip_ref.open(file_list[0])
+                        return BytesIO(doc_file.read())
         return BytesIO(b'')
 
     # DEPRECATED MODEL
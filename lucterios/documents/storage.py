@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.documents package
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+from os import stat, unlink, replace, makedirs, scandir, fsync, close, utime, O_RDONLY
+from os import open as os_open
+from os.path import join, isfile, isdir, dirname
+from shutil import copyfileobj
+from hashlib import md5
+from uuid import uuid4
+from time import time
+from threading import RLock
+from contextlib import contextmanager
+try:
+    from fcntl import flock, LOCK_EX, LOCK_UN
+except ImportError:
+    flock = None
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from lucterios.framework.filetools import get_user_path
+
+
+def sync_directory(dir_path):
+    try:
+        dir_fd = os_open(dir_path, O_RDONLY)
+    except OSError:
+        return
+    try:
+        fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        close(dir_fd)
+
+
+class DocumentStorage(object):
+
+    CHUNK_SIZE = 64 * 1024
+
+    _lock = RLock()
+
+    def __init__(self, rootpath="documents", params=None):
+        self.rootpath = rootpath
+        self.params = params if params is not None else {}
+
+    def path(self, name):
+        raise NotImplementedError()
+
+    def exists(self, name):
+        raise NotImplementedError()
+
+    def stat(self, name):
+        raise NotImplementedError()
+
+    def open(self, name):
+        raise NotImplementedError()
+
+    def temp_path(self):
+        raise NotImplementedError()
+
+    def commit(self, name, tmp_path):
+        raise NotImplementedError()
+
+    def delete(self, name):
+        raise NotImplementedError()
+
+    def touch(self, name):
+        raise NotImplementedError()
+
+    @contextmanager
+    def lock(self):
+        # serializes the blob commits and releases of this process
+        with self._lock:
+            yield
+
+    def save(self, name, content):
+        tmp_path = self.temp_path()
+        try:
+            with open(tmp_path, 'wb') as tmp_file:
+                if isinstance(content, bytes):
+                    tmp_file.write(content)
+                else:
+                    copyfileobj(content, tmp_file, self.CHUNK_SIZE)
+            self.commit(name, tmp_path)
+        finally:
+            if isfile(tmp_path):
+                unlink(tmp_path)
+
+
+class LocalStorage(DocumentStorage):
+
+    @property
+    def root(self):
+        return get_user_path(self.rootpath, '')
+
+    def path(self, name):
+        return join(self.root, name)
+
+    def exists(self, name):
+        return isfile(self.path(name))
+
+    def stat(self, name):
+        try:
+            return stat(self.path(name))
+        except FileNotFoundError:
+            return None
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def temp_path(self):
+        return join(self.root, "tmp_%s" % uuid4().hex)
+
+    def target_path(self, name):
+        return self.path(name)
+
+    def commit(self, name, tmp_path):
+        file_path = self.target_path(name)
+        if not isdir(dirname(file_path)):
+            makedirs(dirname(file_path), exist_ok=True)
+        with open(tmp_path, 'rb') as tmp_file:
+            fsync(tmp_file.fileno())
+        replace(tmp_path, file_path)
+        sync_directory(dirname(file_path))
+
+    def delete(self, name):
+        file_path = self.path(name)
+        if isfile(file_path):
+            unlink(file_path)
+
+    def touch(self, name):
+        # explicit time: the kernel file timestamps use a coarser clock
+        now = time()
+        utime(self.path(name), (now, now))
+
+    @contextmanager
+    def lock(self):
+        # also serialized between processes sharing the same root
+        with DocumentStorage.lock(self):
+            if flock is None:
+                yield
+            else:
+                if not isdir(self.root):
+                    makedirs(self.root, exist_ok=True)
+                with open(join(self.root, '.lock'), 'a') as lock_file:
+                    flock(lock_file.fileno(), LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        flock(lock_file.fileno(), LOCK_UN)
+
+
+class ShardedStorage(LocalStorage):
+
+    MIGRABLE_PREFIXES = ('container_', 'blob_', 'miniature_', 'document_')
+
+    def __init__(self, rootpath="documents", params=None):
+        LocalStorage.__init__(self, rootpath, params)
+        self.levels = int(self.params.get('levels', 2))
+
+    def flat_path(self, name):
+        return join(self.root, name)
+
+    def sharded_path(self, name):
+        name_hash = md5(name.encode()).hexdigest()
+        shards = [name_hash[level * 2:level * 2 + 2] for level in range(self.levels)]
+        return join(self.root, *shards, name)
+
+    def path(self, name):
+        file_path = self.sharded_path(name)
+        if not isfile(file_path):
+            flat_path = self.flat_path(name)
+            if isfile(flat_path):
+                return flat_path
+        return file_path
+
+    def open(self, name):
+        try:
+            return open(self.path(name), 'rb')
+        except FileNotFoundError:
+            # moved by a concurrent migration between resolution and opening
+            return open(self.sharded_path(name), 'rb')
+
+    def target_path(self, name):
+        return self.sharded_path(name)
+
+    def commit(self, name, tmp_path):
+        LocalStorage.commit(self, name, tmp_path)
+        flat_path = self.flat_path(name)
+        if isfile(flat_path):
+            unlink(flat_path)
+
+    def delete(self, name):
+        for file_path in (self.sharded_path(name), self.flat_path(name)):
+            if isfile(file_path):
+                unlink(file_path)
+
+    def flat_names(self):
+        with scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.startswith(self.MIGRABLE_PREFIXES):
+                    yield entry.name
+
+    def relocate(self, name):
+        flat_path = self.flat_path(name)
+        if not isfile(flat_path):
+            return False
+        file_path = self.sharded_path(name)
+        if isfile(file_path):
+            unlink(flat_path)
+        else:
+            if not isdir(dirname(file_path)):
+                makedirs(dirname(file_path), exist_ok=True)
+            replace(flat_path, file_path)
+            sync_directory(dirname(file_path))
+        return True
+
+
+STORAGE_BACKENDS = {'local': LocalStorage, 'sharded': ShardedStorage}
+
+
+def get_storage(rootpath="documents"):
+    storage_params = getattr(settings, 'DOCUMENTS_STORAGE', {})
+    backend = storage_params.get('backend', 'sharded')
+    if backend in STORAGE_BACKENDS:
+        storage_class = STORAGE_BACKENDS[backend]
+    else:
+        storage_class = import_string(backend)
+    return storage_class(rootpath, storage_params)
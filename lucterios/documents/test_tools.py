@@ -25,6 +25,7 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 from os.path import join, dirname
 from zipfile import ZipFile
+from _io import BytesIO
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from threading import Thread
 from cgi import parse_header, parse_multipart
@@ -32,14 +33,20 @@ from urllib.parse import parse_qs
 
 from django.utils import timezone
 
-from lucterios.framework.filetools import get_user_path
-
 from lucterios.CORE.models import LucteriosGroup
 
 from lucterios.documents.models import FolderContainer, DocumentContainer
+from lucterios.documents.storage import get_storage
 from lucterios.framework.test import add_empty_user
 
 
+def save_container(doc, file_path):
+    zip_buffer = BytesIO()
+    with ZipFile(zip_buffer, 'w') as zip_ref:
+        zip_ref.write(file_path, arcname=doc.name)
+    get_storage().save(doc.legacy_name, zip_buffer.getvalue())
+
+
 def create_doc(user, with_folder=True):
     root_path = join(dirname(__file__), 'docs', 'fr')
     current_date = timezone.now()
@@ -48,24 +55,21 @@ def create_doc(user, with_folder=True):
     if with_folder:
         new_doc1.parent = FolderContainer.objects.get(id=2)
     new_doc1.save()
-    with ZipFile(get_user_path('documents', 'container_%d' % new_doc1.id), 'w') as zip_ref:
-        zip_ref.write(join(root_path, 'configuration.png'), arcname='doc1.png')
+    save_container(new_doc1, join(root_path, 'configuration.png'))
 
     new_doc2 = DocumentContainer.objects.create(name='doc2.png', description="doc 2", creator=user,
                                                 date_creation=current_date, date_modification=current_date)
     if with_folder:
         new_doc2.parent = FolderContainer.objects.get(id=1)
     new_doc2.save()
-    with ZipFile(get_user_path('documents', 'container_%d' % new_doc2.id), 'w') as zip_ref:
-        zip_ref.write(join(root_path, 'listdoc.png'), arcname='doc2.png')
+    save_container(new_doc2, join(root_path, 'listdoc.png'))
 
     new_doc3 = DocumentContainer.objects.create(name='doc3.png', description="doc 3", creator=user,
                                                 date_creation=current_date, date_modification=current_date)
     if with_folder:
         new_doc3.parent = FolderContainer.objects.get(id=4)
     new_doc3.save()
-    with ZipFile(get_user_path('documents', 'container_%d' % new_doc3.id), 'w') as zip_ref:
-        zip_ref.write(join(root_path, 'showdoc.png'), arcname='doc3.png')
+    save_container(new_doc3, join(root_path, 'showdoc.png'))
     return current_date
 
 
@@ -23,22 +23,45 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
-from os.path import join, dirname, exists
-from shutil import rmtree
+from os import listdir, makedirs, lseek, pread
+from os.path import join, dirname, exists, getsize
+from shutil import rmtree, which
+from importlib.util import find_spec
+from hashlib import sha256, md5
+from zipfile import ZIP_STORED, ZIP_DEFLATED, ZIP_LZMA
+import re
 import json
+import tracemalloc
+from io import StringIO, BytesIO, SEEK_END, SEEK_CUR
 
 from django.contrib.auth.models import Permission
 from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
+from time import time
+from django.core.management import call_command
+from django.http.response import FileResponse
+from django.test.client import RequestFactory
+from django.db import connection, IntegrityError, transaction
+from django.db.models.aggregates import Count
+from django.test.utils import CaptureQueriesContext
 
 from lucterios.framework.test import LucteriosTest, find_free_port
+from lucterios.framework.error import LucteriosException
+from lucterios.framework.xfercomponents import MOSAIC_ORDER, MOSAIC_PAGE
 from lucterios.framework.filetools import get_user_path, get_user_dir
 
 from lucterios.CORE.models import LucteriosGroup, LucteriosUser
+from lucterios.CORE.parameters import Params
 
-from lucterios.documents.models import FolderContainer, DocumentContainer
+from lucterios.documents.models import FolderContainer, DocumentContainer, PermissionResolver, FolderPermission, AbstractContainer, FolderTitleCache, \
+    get_container_info
+from lucterios.documents.storage import get_storage, ShardedStorage
+from lucterios.documents.thumbnails import ThumbnailQueue, limit_worker_memory, MINIATURE_HEIGHT
+from lucterios.documents.doc_editors import DocEditor
 from lucterios.documents.views import FolderList, FolderAddModify, FolderDel, \
-    DocumentMosaic, DocumentAddModify, DocumentShow, DocumentDel, DocumentSearch, \
-    DocumentChangeShared, DownloadFile, ContainerAddFile, DocumentEditor
+    DocumentMosaic, MOSAIC_CURSOR, DocumentAddModify, DocumentShow, DocumentDel, DocumentSearch, \
+    DocumentChangeShared, DownloadFile, ContainerAddFile, DocumentEditor, FolderMiniatures, get_content_response
 from lucterios.documents.test_tools import default_groups, default_folders, \
     create_doc, TestHTTPServer, TestMoke
 
@@ -124,6 +147,109 @@ class FolderTest(LucteriosTest):
         self.assert_observer('core.custom', 'lucterios.documents', 'folderList')
         self.assert_count_equal('folder', 0)
 
+    def test_permission_queries(self):
+        user = LucteriosUser.objects.get(username='empty')
+        user.groups.set(LucteriosGroup.objects.filter(id__in=[1]))
+        root_folder = FolderContainer.objects.create(name='root', description='root')
+        folders = [FolderContainer.objects.create(name='folder%04d' % idx, description='folder', parent=root_folder) for idx in range(1000)]
+        FolderContainer.viewer.through.objects.bulk_create([FolderContainer.viewer.through(foldercontainer_id=folder.id, lucteriosgroup_id=1 if (idx % 2) == 0 else 2)
+                                                            for idx, folder in enumerate(folders)])
+        FolderContainer.modifier.through.objects.bulk_create([FolderContainer.modifier.through(foldercontainer_id=folder.id, lucteriosgroup_id=1)
+                                                              for idx, folder in enumerate(folders) if (idx % 4) == 0])
+        FolderPermission.refresh([folder.id for folder in folders])
+        PermissionResolver.clear()
+        Params.getvalue("CORE-connectmode")
+
+        with CaptureQueriesContext(connection) as queries:
+            viewable = root_folder.get_subfolders(user, False)
+            modifiable = root_folder.get_subfolders(user, True)
+            for folder in folders:
+                folder.cannot_view(user)
+                folder.is_readonly(user)
+        self.assertLessEqual(len(queries), 6)
+        self.assertEqual(len(viewable), 500)
+        self.assertEqual(len(modifiable), 250)
+        self.assertFalse(folders[0].cannot_view(user))
+        self.assertFalse(folders[0].is_readonly(user))
+        self.assertTrue(folders[1].cannot_view(user))
+        self.assertTrue(folders[2].is_readonly(user))
+
+        folders[1].viewer.add(LucteriosGroup.objects.get(id=1))
+        self.assertFalse(folders[1].cannot_view(user))
+
+    def test_permission_table(self):
+        folder = FolderContainer.objects.create(name='truc', description='blabla')
+        folder.viewer.set(LucteriosGroup.objects.filter(id__in=[1, 2]))
+        folder.modifier.set(LucteriosGroup.objects.filter(id__in=[2]))
+        self.assertEqual(sorted(FolderPermission.objects.filter(folder=folder).values_list('group_id', 'can_view', 'can_modify')), [(1, True, False), (2, True, True)])
+        folder.viewer.remove(LucteriosGroup.objects.get(id=2))
+        self.assertEqual(sorted(FolderPermission.objects.filter(folder=folder).values_list('group_id', 'can_view', 'can_modify')), [(1, True, False), (2, False, True)])
+        LucteriosGroup.objects.get(id=1).foldercontainer_viewer.clear()
+        self.assertEqual(sorted(FolderPermission.objects.filter(folder=folder).values_list('group_id', 'can_view', 'can_modify')), [(2, False, True)])
+        LucteriosGroup.objects.get(id=1).foldercontainer_modifier.add(folder)
+        self.assertEqual(sorted(FolderPermission.objects.filter(folder=folder).values_list('group_id', 'can_view', 'can_modify')), [(1, False, True), (2, False, True)])
+
+        user = LucteriosUser.objects.get(username='empty')
+        user.groups.set(LucteriosGroup.objects.filter(id__in=[1, 2]))
+        folder.viewer.set(LucteriosGroup.objects.filter(id__in=[1, 2]))
+        self.assertEqual(list(FolderContainer.objects.filter(id__in=FolderPermission.viewable_folders(user))), [folder])
+        folder.delete()
+        self.assertEqual(FolderPermission.objects.all().count(), 0)
+
+    def test_folder_path(self):
+        folder1 = FolderContainer.objects.create(name='f1', description='f1')
+        folder2 = FolderContainer.objects.create(name='f2', description='f2', parent=folder1)
+        folder3 = FolderContainer.objects.create(name='f3', description='f3', parent=folder2)
+        folder4 = FolderContainer.objects.create(name='f4', description='f4')
+        self.assertEqual(FolderContainer.objects.get(id=folder3.id).path, '/%d/%d/%d/' % (folder1.id, folder2.id, folder3.id))
+        with self.assertNumQueries(1):
+            self.assertEqual(folder3.get_title(), '>f1>f2>f3')
+        self.assertEqual(list(folder1.get_descendant_folders().order_by('id')), [folder2, folder3])
+
+        folder2.parent = folder4
+        folder2.save()
+        self.assertEqual(FolderContainer.objects.get(id=folder3.id).path, '/%d/%d/%d/' % (folder4.id, folder2.id, folder3.id))
+        self.assertEqual(FolderContainer.objects.get(id=folder3.id).get_title(), '>f4>f2>f3')
+
+        folder4.parent = folder3
+        with self.assertRaises(LucteriosException):
+            folder4.save()
+        folder4 = FolderContainer.objects.get(id=folder4.id)
+        self.assertEqual(folder4.path, '/%d/' % folder4.id)
+
+        AbstractContainer.objects.filter(id=folder4.id).update(parent=folder3)
+        FolderContainer.rebuild_paths()
+        self.assertEqual(FolderContainer.objects.filter(parent=None).count(), 2)
+        for folder in FolderContainer.objects.all():
+            parent_path = folder.parent.path if folder.parent_id is not None else '/'
+            self.assertEqual(folder.path, '%s%d/' % (parent_path, folder.id))
+
+    def test_folder_title_cache(self):
+        parent_folder = None
+        for idx in range(50):
+            parent_folder = FolderContainer.objects.create(name='f%02d' % idx, description='folder', parent=parent_folder)
+        folders = list(FolderContainer.objects.all().order_by('id'))
+        new_doc = DocumentContainer.objects.create(name='doc.txt', description="doc", parent=parent_folder, date_creation=timezone.now(), date_modification=timezone.now())
+        new_doc = DocumentContainer.objects.get(id=new_doc.id)
+        FolderTitleCache.clear()
+        with self.assertNumQueries(2):
+            doc_title = str(new_doc)
+        self.assertEqual(len(FolderTitleCache.get_folders()), 50)
+        FolderTitleCache.clear()
+        with self.assertNumQueries(1):
+            titles = [str(folder) for folder in reversed(folders)][::-1]
+            doc_title = str(new_doc)
+        self.assertEqual(titles[2], '>f00>f01>f02')
+        self.assertEqual(doc_title, '[%s] doc.txt' % titles[-1])
+        FolderTitleCache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(str(folders[2]), '>f00>f01>f02')
+        self.assertEqual(sorted(FolderTitleCache.get_folders().keys()), [folder.id for folder in folders[:3]])
+
+        folders[1].name = 'new name'
+        folders[1].save()
+        self.assertEqual(str(folders[2]), '>f00>new name>f02')
+
 
 class DocumentTest(LucteriosTest):
 
@@ -134,6 +260,7 @@ class DocumentTest(LucteriosTest):
         if hasattr(settings, "ETHERCALC"):
             settings.ETHERCALC = {}
 
+        ThumbnailQueue.wait()
         rmtree(get_user_dir(), True)
         default_groups()
         default_folders()
@@ -250,7 +377,7 @@ class DocumentTest(LucteriosTest):
     def test_addsave(self):
         self.factory.user = LucteriosUser.objects.get(username='empty')
 
-        self.assertFalse(exists(get_user_path('documents', 'container_5')))
+        self.assertFalse(get_storage().exists('container_5'))
         file_path = join(dirname(__file__), 'docs', 'en', 'listdoc.png')
 
         docs = DocumentContainer.objects.all()
@@ -271,7 +398,10 @@ class DocumentTest(LucteriosTest):
         self.assertEqual(docs[0].creator.username, "empty")
         self.assertEqual(docs[0].modifier.username, "empty")
         self.assertEqual(docs[0].date_creation, docs[0].date_modification)
-        self.assertTrue(exists(get_user_path('documents', 'container_5')))
+        self.assertEqual(docs[0].size, getsize(file_path))
+        self.assertEqual(docs[0].file_path, get_storage().path('blob_%s' % docs[0].checksum))
+        self.assertTrue(exists(docs[0].file_path))
+        self.assertFalse(get_storage().exists('container_5'))
 
     def test_saveagain(self):
         current_date = create_doc(self.factory.user)
@@ -370,7 +500,7 @@ class DocumentTest(LucteriosTest):
             self.assertEqual(new_doc.parent_id, None)
             self.assertEqual(new_doc.name, 'aa.bb.txt')
             self.assertEqual(new_doc.description, "blablabla")
-            self.assertTrue(not exists(get_user_path('documents', 'container_5')))
+            self.assertTrue(not get_storage().exists('container_5'))
 
             TestMoke.initial(['{"code": 0, "message":"ok", "data": null}',
                               '{"code": 0, "message":"ok", "data": null}'])
@@ -471,7 +601,7 @@ class DocumentTest(LucteriosTest):
             self.assertEqual(new_doc.parent_id, None)
             self.assertEqual(new_doc.name, 'aa.bb.csv')
             self.assertEqual(new_doc.description, "blablabla")
-            self.assertTrue(not exists(get_user_path('documents', 'container_5')))
+            self.assertTrue(not get_storage().exists('container_5'))
 
             TestMoke.initial(['', 'false', ''])
             self.factory.xfer = DocumentEditor()
@@ -513,7 +643,7 @@ class DocumentTest(LucteriosTest):
         self.assert_observer('core.custom', 'lucterios.documents', 'documentMosaic')
         self.assert_count_equal('document', 2)
         self.assert_json_equal('', "document/@0/id", "5")
-        self.assert_json_equal('', "document/@0/image", "data:image/png;base64,iVBORw0", True)
+        self.assert_json_equal('', "document/@0/image", "mdi:mdi-image-outline")
         self.assert_json_equal('', "document/@0/name", "doc 1")
         self.assert_json_equal('', "document/@0/info", "<b>nom</b> doc1.png<br/>\n<b>description</b> doc 1<br/>\n<b>modificateur</b> ---<br/>\n<b>date de modification</b>", True)
         self.assert_json_equal('', "document/@0/group", "DocumentContainer")
@@ -522,17 +652,18 @@ class DocumentTest(LucteriosTest):
         self.assert_json_equal('', "document/@1/name", "truc3")
         self.assert_json_equal('', "document/@1/info", "<b>nom</b> truc3<br/>\n<b>description</b> ----<br/>\n")
         self.assert_json_equal('', "document/@1/group", "FolderContainer")
-        self.assertTrue(exists(get_user_path('documents', 'container_5')))
+        self.assertTrue(get_storage().exists('container_5'))
 
         self.factory.xfer = DocumentDel()
-        self.calljson('/lucterios.documents/documentDel', {"document": "5", "CONFIRME": 'YES'}, False)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.calljson('/lucterios.documents/documentDel', {"document": "5", "CONFIRME": 'YES'}, False)
         self.assert_observer('core.acknowledge', 'lucterios.documents', 'documentDel')
 
         self.factory.xfer = DocumentMosaic()
         self.calljson('/lucterios.documents/documentMosaic', {"document": "2"}, False)
         self.assert_count_equal('document', 1)
         self.assert_json_equal('', "document/@0/id", "3")
-        self.assertFalse(exists(get_user_path('documents', 'container_5')))
+        self.assertFalse(get_storage().exists('container_5'))
 
     def test_readonly(self):
         current_date = create_doc(self.factory.user)
@@ -643,3 +774,636 @@ class DocumentTest(LucteriosTest):
         self.call_ex('/lucterios.documents/downloadFile', {"shared": shared_key, "filename": "doc1.png"}, False)
         file_content = self.response.getvalue().decode()
         self.assertEqual(file_content, 'Fichier non trouvé !')
+
+    def test_content_stream(self):
+        create_doc(self.factory.user)
+        doc = DocumentContainer.objects.get(id=5)
+        content = doc.content.read()
+        chunks = list(doc.iter_content(1024))
+        self.assertEqual(len(chunks), (len(content) + 1023) // 1024)
+        self.assertEqual(max([len(chunk) for chunk in chunks]), 1024)
+        self.assertEqual(b''.join(chunks), content)
+
+        self.factory.xfer = DownloadFile()
+        self.call_ex('/lucterios.documents/downloadFile', {"fileid": 5, "filename": "doc1.png"}, False)
+        self.assertEqual(self.response.getvalue(), content)
+
+    def test_file_info(self):
+        create_doc(self.factory.user)
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.size, None)
+        self.assertEqual(doc.checksum, None)
+        content = doc.content.read()
+
+        response = self.client.get('/lucterios.documents/files/5', {'access_token': '%d-%s' % (self.factory.user.id, doc.date_modification.timestamp())})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode())['Size'], len(content))
+        response = self.client.get('/lucterios.documents/files/5/contents', {'access_token': '%d-%s' % (self.factory.user.id, doc.date_modification.timestamp())})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), content)
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.checksum, None)
+        self.assertTrue(get_storage().exists('container_5'))
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('documents_fileinfo', batch_size=2, stdout=out)
+        self.assertIn('3 legacy container(s) refreshed', out.getvalue())
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.size, len(content))
+        self.assertEqual(doc.compressed_size, getsize(doc.file_path))
+        self.assertEqual(doc.checksum, sha256(content).hexdigest())
+        self.assertFalse(get_storage().exists('container_5'))
+
+        doc.content = b'new content'
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.size, 11)
+        self.assertEqual(doc.checksum, sha256(b'new content').hexdigest())
+        response = self.client.get('/lucterios.documents/files/5', {'access_token': '%d-%s' % (self.factory.user.id, doc.date_modification.timestamp())})
+        self.assertEqual(json.loads(response.content.decode())['Size'], 11)
+
+        doc.content = b''
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.size, None)
+        self.assertEqual(doc.checksum, None)
+
+    def test_blob_dedup(self):
+        create_doc(self.factory.user)
+        doc1 = DocumentContainer.objects.get(id=5)
+        doc2 = DocumentContainer.objects.get(id=6)
+        with self.captureOnCommitCallbacks(execute=True):
+            doc1.content = b'same content'
+            doc2.content = b'same content'
+        self.assertEqual(doc1.checksum, doc2.checksum)
+        self.assertEqual(doc1.file_path, doc2.file_path)
+        self.assertFalse(get_storage().exists('container_5'))
+        self.assertFalse(get_storage().exists('container_6'))
+        blob_path = doc1.file_path
+        self.assertTrue(exists(blob_path))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            doc1.delete()
+        self.assertTrue(exists(blob_path))
+        self.assertEqual(DocumentContainer.objects.get(id=6).content.read(), b'same content')
+
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            doc2.content = b'other content'
+        self.assertTrue(exists(blob_path))
+        for callback in callbacks:
+            callback()
+        self.assertFalse(exists(blob_path))
+        self.assertTrue(exists(doc2.file_path))
+        blob_path = doc2.file_path
+        with self.captureOnCommitCallbacks(execute=True):
+            doc2.delete()
+        self.assertFalse(exists(blob_path))
+
+        doc3 = DocumentContainer.objects.get(id=7)
+        with self.captureOnCommitCallbacks(execute=True):
+            doc3.content = b'reused content'
+        checksum = doc3.checksum
+        blob_path = doc3.file_path
+        with self.captureOnCommitCallbacks(execute=False):
+            doc3.content = b'changed content'
+            released_at = time()
+            doc3.content = b'reused content'
+        # reuse not committed yet: only the blob mtime reveals it
+        DocumentContainer.objects.filter(id=7).update(checksum=None)
+        DocumentContainer.release_blob(checksum, released_at)
+        self.assertTrue(exists(blob_path))
+        DocumentContainer.release_blob(checksum, time())
+        self.assertFalse(exists(blob_path))
+
+    def test_storage_sharded(self):
+        create_doc(self.factory.user)
+        with self.settings(DOCUMENTS_STORAGE={'backend': 'sharded', 'levels': 2}):
+            storage = get_storage()
+            self.assertIsInstance(storage, ShardedStorage)
+            blob_path = storage.path('blob_abcdef')
+            self.assertEqual(blob_path, join(get_user_path('documents', ''), md5(b'blob_abcdef').hexdigest()[0:2], md5(b'blob_abcdef').hexdigest()[2:4], 'blob_abcdef'))
+            storage.save('blob_abcdef', b'12345')
+            self.assertTrue(storage.exists('blob_abcdef'))
+            self.assertEqual(storage.stat('blob_abcdef').st_size, 5)
+            with storage.open('blob_abcdef') as blob_file:
+                self.assertEqual(blob_file.read(), b'12345')
+            storage.delete('blob_abcdef')
+            self.assertFalse(storage.exists('blob_abcdef'))
+            self.assertEqual(storage.stat('blob_abcdef'), None)
+
+            doc = DocumentContainer.objects.get(id=5)
+            doc.content = b'sharded content'
+            doc = DocumentContainer.objects.get(id=5)
+            self.assertEqual(dirname(dirname(dirname(doc.file_path))), dirname(get_user_path('documents', 'blob')))
+            self.assertTrue(exists(doc.file_path))
+            self.assertEqual(doc.content.read(), b'sharded content')
+            self.assertEqual(b''.join(doc.iter_content()), b'sharded content')
+            blob_path = doc.file_path
+            with self.captureOnCommitCallbacks(execute=True):
+                doc.delete()
+            self.assertFalse(exists(blob_path))
+
+    def test_storage_relocate(self):
+        with self.settings(DOCUMENTS_STORAGE={'backend': 'local'}):
+            create_doc(self.factory.user)
+            self.assertTrue(exists(get_user_path('documents', 'container_5')))
+        storage = get_storage()
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.file_path, get_user_path('documents', 'container_5'))
+        content = doc.content.read()
+        self.assertEqual(sorted(storage.flat_names()), ['container_5', 'container_6', 'container_7'])
+
+        call_command('documents_relocate', batch_size=2, limit=2, stdout=StringIO())
+        self.assertEqual(len(list(storage.flat_names())), 1)
+        call_command('documents_relocate', batch_size=2, stdout=StringIO())
+        self.assertEqual(list(storage.flat_names()), [])
+        self.assertFalse(exists(get_user_path('documents', 'container_5')))
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.file_path, storage.sharded_path('container_5'))
+        self.assertTrue(exists(doc.file_path))
+        self.assertEqual(doc.content.read(), content)
+
+    def test_compression_policy(self):
+        create_doc(self.factory.user)
+        doc = DocumentContainer.objects.get(id=5)
+        with open(join(dirname(__file__), 'docs', 'fr', 'configuration.png'), 'rb') as png_file:
+            png_content = png_file.read()
+        doc.content = png_content
+        self.assertEqual(doc.compress_type, ZIP_STORED)
+        self.assertEqual(doc.content.read(), png_content)
+
+        text_content = ('Lorem ipsum dolor sit amet\n' * 200).encode()
+        doc.content = text_content
+        self.assertEqual(doc.compress_type, ZIP_DEFLATED)
+        self.assertEqual(doc.content.read(), text_content)
+        self.assertLess(doc.compressed_size, doc.size)
+
+        with self.settings(DOCUMENTS_COMPRESSION={'text': ('lzma', None)}):
+            text_content = ('Consectetur adipiscing elit\n' * 200).encode()
+            doc.content = text_content.decode()
+            self.assertEqual(doc.compress_type, ZIP_LZMA)
+            self.assertEqual(doc.content.read(), text_content)
+
+    def test_content_atomic(self):
+        class BrokenStream(object):
+
+            def __init__(self):
+                self.nb_read = 0
+
+            def read(self, size=-1):
+                self.nb_read += 1
+                if self.nb_read > 2:
+                    raise IOError('connection lost')
+                return b'x' * 1024
+
+        create_doc(self.factory.user)
+        doc = DocumentContainer.objects.get(id=5)
+        content = doc.content.read()
+        with self.assertRaises(IOError):
+            doc.content = BrokenStream()
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.content.read(), content)
+        self.assertEqual([name for name in listdir(get_user_path('documents', '')) if name.startswith('tmp_')], [])
+
+    def test_download_stored(self):
+        create_doc(self.factory.user)
+        doc = DocumentContainer.objects.get(id=5)
+        with open(join(dirname(__file__), 'docs', 'fr', 'configuration.png'), 'rb') as png_file:
+            png_content = png_file.read()
+        doc.content = png_content
+        with doc.open_stored_content() as stored_content:
+            self.assertEqual(stored_content.read(10), png_content[:10])
+            stored_content.seek(-10, SEEK_END)
+            self.assertEqual(stored_content.read(), png_content[-10:])
+
+        self.factory.xfer = DownloadFile()
+        self.call_ex('/lucterios.documents/downloadFile', {"fileid": 5, "filename": "doc1.png"}, False)
+        self.assertIsInstance(self.response, FileResponse)
+        self.assertEqual(self.response['Content-Length'], str(len(png_content)))
+        self.assertEqual(self.response.getvalue(), png_content)
+
+        # a sendfile server reads from the OS position of the descriptor
+        for range_header, expected_content in (('', png_content), ('bytes=100-199', png_content[100:200]), ('bytes=2-5', png_content[2:6])):
+            response = get_content_response(doc, RequestFactory().get('/lucterios.documents/files/5/contents', HTTP_RANGE=range_header))
+            self.assertIsInstance(response, FileResponse)
+            stored_content = response.file_to_stream
+            position = lseek(stored_content.fileno(), 0, SEEK_CUR)
+            self.assertEqual(pread(stored_content.fileno(), len(expected_content), position), expected_content)
+            self.assertEqual(b''.join(response.streaming_content), expected_content)
+
+        doc.content = ('Lorem ipsum dolor sit amet\n' * 200).encode()
+        self.assertEqual(doc.open_stored_content(), None)
+        self.factory.xfer = DownloadFile()
+        self.call_ex('/lucterios.documents/downloadFile', {"fileid": 5, "filename": "doc1.png"}, False)
+        self.assertNotIsInstance(self.response, FileResponse)
+        self.assertEqual(self.response.getvalue(), ('Lorem ipsum dolor sit amet\n' * 200).encode())
+
+    def test_download_range(self):
+        create_doc(self.factory.user)
+        doc = DocumentContainer.objects.get(id=5)
+        content = doc.content.read()
+        access_token = {'access_token': '%d-%s' % (self.factory.user.id, doc.date_modification.timestamp())}
+        response = self.client.get('/lucterios.documents/files/5/contents', access_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), content)
+        self.assertFalse(response.has_header('ETag'))
+        call_command('documents_fileinfo', stdout=StringIO())
+        response = self.client.get('/lucterios.documents/files/5/contents', access_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), content)
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(response['ETag'], '"%s"' % doc.checksum)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        response = self.client.get('/lucterios.documents/files/5/contents', access_token, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/lucterios.documents/files/5/contents', access_token, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/lucterios.documents/files/5/contents', access_token, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/%d' % len(content))
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(b''.join(response.streaming_content), content[100:200])
+        response = self.client.get('/lucterios.documents/files/5/contents', access_token, HTTP_RANGE='bytes=-50')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), content[-50:])
+        response = self.client.get('/lucterios.documents/files/5/contents', access_token, HTTP_RANGE='bytes=%d-' % len(content))
+        self.assertEqual(response.status_code, 416)
+
+        doc.content = ('Lorem ipsum dolor sit amet\n' * 200).encode()
+        doc = DocumentContainer.objects.get(id=5)
+        response = self.client.get('/lucterios.documents/files/5/contents', access_token, HTTP_RANGE='bytes=1000-1999')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), ('Lorem ipsum dolor sit amet\n' * 200).encode()[1000:2000])
+
+    def test_upload_stream(self):
+        class GeneratedStream(object):
+
+            def __init__(self, size):
+                self.remaining = size
+
+            def read(self, size=-1):
+                size = min(size, self.remaining) if size >= 0 else self.remaining
+                self.remaining -= size
+                return b'0123456789abcdef' * (size // 16) + b'#' * (size % 16)
+
+        create_doc(self.factory.user)
+        doc = DocumentContainer.objects.get(id=5)
+        tracemalloc.start()
+        try:
+            doc.upload_content(GeneratedStream(32 * 1024 * 1024))
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 4 * 1024 * 1024)
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.size, 32 * 1024 * 1024)
+        self.assertLess(doc.compressed_size, doc.size)
+        self.assertEqual((doc.size, doc.checksum), get_container_info(doc.file_path, DocumentContainer.CHUNK_SIZE))
+        with open(join(dirname(__file__), 'docs', 'fr', 'showdoc.png'), 'rb') as file_doc:
+            doc.content = file_doc
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual((doc.size, doc.checksum), get_container_info(doc.file_path, DocumentContainer.CHUNK_SIZE))
+
+        access_token = {'access_token': '%d-%s' % (self.factory.user.id, doc.date_modification.timestamp())}
+        response = self.client.post('/lucterios.documents/files/5/contents?access_token=%s' % access_token['access_token'], b'PK\x03\x04 not a container', content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 200)
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.content.read(), b'PK\x03\x04 not a container')
+        response = self.client.post('/lucterios.documents/files/5/contents?access_token=%s' % access_token['access_token'], b'', content_type='application/octet-stream',
+                                    CONTENT_LENGTH='0')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/lucterios.documents/files/5/contents?access_token=%s' % access_token['access_token'], b'abc', content_type='application/octet-stream',
+                                    CONTENT_LENGTH='3 ')
+        self.assertEqual(response.status_code, 400)
+
+        chunked_content = b'0123456789' * 1000
+        response = self.client.post('/lucterios.documents/files/5/contents?access_token=%s' % access_token['access_token'], b'', content_type='application/octet-stream',
+                                    CONTENT_LENGTH='', HTTP_TRANSFER_ENCODING='chunked', **{'wsgi.input': BytesIO(chunked_content)})
+        self.assertEqual(response.status_code, 411)
+        response = self.client.post('/lucterios.documents/files/5/contents?access_token=%s' % access_token['access_token'], b'', content_type='application/octet-stream',
+                                    CONTENT_LENGTH='', HTTP_TRANSFER_ENCODING='chunked', **{'wsgi.input': BytesIO(chunked_content), 'wsgi.input_terminated': True})
+        self.assertEqual(response.status_code, 200)
+        doc = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc.size, len(chunked_content))
+        self.assertEqual(doc.content.read(), chunked_content)
+
+    def test_extract_files(self):
+        create_doc(self.factory.user)
+        extract_dir = join(get_user_dir(), 'extract_test')
+        makedirs(extract_dir)
+        try:
+            FolderContainer.objects.get(id=2).extract_files(extract_dir)
+            self.assertTrue(exists(join(extract_dir, 'doc1.png')))
+            self.assertTrue(exists(join(extract_dir, 'truc4', 'doc3.png')))
+            self.assertFalse(exists(join(extract_dir, 'doc2.png')))
+        finally:
+            rmtree(extract_dir)
+        makedirs(extract_dir)
+        try:
+            FolderContainer().extract_files(extract_dir)
+            self.assertTrue(exists(join(extract_dir, 'truc2', 'doc1.png')))
+            self.assertTrue(exists(join(extract_dir, 'truc1', 'doc2.png')))
+            self.assertTrue(exists(join(extract_dir, 'truc2', 'truc4', 'doc3.png')))
+        finally:
+            rmtree(extract_dir)
+        DocumentContainer.objects.filter(id=5).update(name='../../evil.png')
+        DocumentContainer.objects.filter(id=7).update(name='sub/doc3.png')
+        makedirs(extract_dir)
+        try:
+            FolderContainer.objects.get(id=2).extract_files(extract_dir)
+            self.assertTrue(exists(join(extract_dir, 'evil.png')))
+            self.assertFalse(exists(join(dirname(dirname(extract_dir)), 'evil.png')))
+            self.assertTrue(exists(join(extract_dir, 'truc4', 'doc3.png')))
+        finally:
+            rmtree(extract_dir)
+
+    def test_delete_subtree(self):
+        create_doc(self.factory.user)
+        folder2 = FolderContainer.objects.get(id=2)
+        doc1 = DocumentContainer.objects.get(id=5)
+        doc1.content = b'content 1'
+        doc3 = DocumentContainer.objects.get(id=7)
+        doc3.content = b'content 3'
+        doc2 = DocumentContainer.objects.get(id=6)
+        doc2.content = b'content 3'
+        get_storage().save(doc1.miniature_name, b'png')
+        blob1 = doc1.storage_name
+        blob3 = doc3.storage_name
+
+        folder2.DELETE_BATCH_SIZE = 1
+        with self.settings(DOCUMENTS_PURGE_THREADED=False):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                folder2.delete()
+        self.assertEqual(len(callbacks), 2)
+        self.assertTrue(FolderContainer.wait_purge(60))
+        self.assertEqual(list(DocumentContainer.objects.all().values_list('id', flat=True)), [6])
+        self.assertEqual(list(FolderContainer.objects.filter(id__in=[2, 3, 4]).values_list('id', flat=True)), [])
+        self.assertFalse(get_storage().exists(blob1))
+        self.assertFalse(get_storage().exists(doc1.miniature_name))
+        self.assertTrue(get_storage().exists(blob3))
+        self.assertEqual(DocumentContainer.objects.get(id=6).content.read(), b'content 3')
+        DocumentContainer.purge_files([(7, doc3.checksum)], set([doc3.checksum]))
+        self.assertTrue(get_storage().exists(blob3))
+
+        get_storage().save(doc1.miniature_name, b'png')
+        get_storage().save(doc3.miniature_name, b'png')
+        FolderContainer.start_purge([(5, None)], set())
+        FolderContainer.start_purge([(7, None)], set())
+        self.assertTrue(FolderContainer.wait_purge(60))
+        self.assertIsNone(FolderContainer._purge_worker)
+        self.assertFalse(get_storage().exists(doc1.miniature_name))
+        self.assertFalse(get_storage().exists(doc3.miniature_name))
+
+    def test_mosaic_queries(self):
+        def mosaic_queries():
+            self.factory.xfer = DocumentMosaic()
+            with CaptureQueriesContext(connection) as queries:
+                self.calljson('/lucterios.documents/documentMosaic', {'document': 2}, False)
+            self.assert_observer('core.custom', 'lucterios.documents', 'documentMosaic')
+            return len(queries)
+
+        current_date = create_doc(self.factory.user)
+        mosaic_queries()
+        nb_queries = mosaic_queries()
+        self.assert_json_equal('', '#document/nb_items', 2)
+        for idx in range(20):
+            DocumentContainer.objects.create(name='extra%02d.txt' % idx, description="extra", parent_id=2, creator=self.factory.user, modifier=self.factory.user,
+                                             date_creation=current_date, date_modification=current_date)
+        self.assertEqual(mosaic_queries(), nb_queries)
+        self.assert_json_equal('', '#document/nb_items', 22)
+
+    def test_mosaic_order_datemodif(self):
+        current_date = create_doc(self.factory.user)
+        dated_ids = []
+        for idx, delta in enumerate([3, 1, 2]):
+            dated_doc = DocumentContainer.objects.create(name='dated%d.txt' % idx, description="dated", parent_id=2, creator=self.factory.user,
+                                                         date_creation=current_date, date_modification=current_date - timedelta(days=delta))
+            dated_ids.append(dated_doc.id)
+        self.factory.xfer = DocumentMosaic()
+        with CaptureQueriesContext(connection) as queries:
+            self.calljson('/lucterios.documents/documentMosaic', {'document': 2, MOSAIC_ORDER + 'document': 'datemodif'}, False)
+        self.assert_observer('core.custom', 'lucterios.documents', 'documentMosaic')
+        self.assertEqual([item['id'] for item in self.get_json_path('document')], [dated_ids[0], dated_ids[2], dated_ids[1], 5, 3])
+        self.assertEqual(len([query for query in queries.captured_queries if ('COALESCE' in query['sql']) and ('ORDER BY' in query['sql']) and query['sql'].endswith('LIMIT 50')]), 1)
+
+        self.factory.xfer = DocumentMosaic()
+        self.calljson('/lucterios.documents/documentMosaic', {'document': 2, MOSAIC_ORDER + 'document': '-datemodif'}, False)
+        self.assertEqual([item['id'] for item in self.get_json_path('document')], [3, 5, dated_ids[1], dated_ids[2], dated_ids[0]])
+
+    def test_mosaic_keyset(self):
+        current_date = create_doc(self.factory.user)
+        for idx in range(120):
+            DocumentContainer.objects.create(name='page%03d.txt' % ((idx * 7) % 120), description="page", parent_id=2, creator=self.factory.user,
+                                             date_creation=current_date, date_modification=current_date)
+        offset_ids = []
+        for page_num in range(3):
+            self.factory.xfer = DocumentMosaic()
+            self.calljson('/lucterios.documents/documentMosaic', {'document': 2, MOSAIC_PAGE + 'document': page_num}, False)
+            offset_ids.extend([item['id'] for item in self.get_json_path('document')])
+        self.assertEqual(len(offset_ids), 122)
+
+        mosaic_ids = []
+        context = {'document': 2}
+        for page_num in range(3):
+            context[MOSAIC_PAGE + 'document'] = page_num
+            self.factory.xfer = DocumentMosaic()
+            with CaptureQueriesContext(connection) as queries:
+                self.calljson('/lucterios.documents/documentMosaic', context, False)
+            self.assert_observer('core.custom', 'lucterios.documents', 'documentMosaic')
+            self.assert_json_equal('', '#document/page_num', page_num)
+            mosaic_ids.extend([item['id'] for item in self.get_json_path('document')])
+            if page_num > 0:
+                self.assertEqual(len([query for query in queries.captured_queries if 'OFFSET' in query['sql']]), 0)
+            context = dict(self.json_context)
+        self.assertEqual(mosaic_ids, offset_ids)
+        self.assertFalse((MOSAIC_CURSOR + 'document') in context)
+
+    def test_query_plans(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('query plan checked on sqlite only')
+        current_date = create_doc(self.factory.user)
+        for idx in range(200):
+            doc = DocumentContainer.objects.create(name='plan%03d.txt' % idx, description="plan", parent_id=2 + (idx % 2), creator=self.factory.user,
+                                                   date_creation=current_date, date_modification=current_date)
+            doc.change_sharekey(False)
+            doc.save()
+        doc = DocumentContainer.objects.get(name='plan123.txt')
+        doc_fields = ("name", "description", "parent", "date_modification", "modifier")
+        for query_set in (AbstractContainer.objects.filter(parent_id=2, name='plan122.txt'),
+                          DocumentContainer.objects.filter(name=doc.name, sharekey=doc.sharekey),
+                          DocumentContainer.objects.filter(id=doc.id, name=doc.name),
+                          FolderContainer.objects.values("name", "description", "parent").annotate(Count('id')).values("name", "description", "parent").order_by().filter(id__count__gt=1),
+                          DocumentContainer.objects.values(*doc_fields).annotate(Count('id')).values(*doc_fields).order_by().filter(id__count__gt=1)):
+            sql, params = query_set.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = [row[-1] for row in cursor.fetchall()]
+            self.assertEqual([detail for detail in plan if re.match(r'^SCAN (TABLE )?\S+( AS \S+)?$', detail)], [], sql)
+        self.assertEqual(query_set.count(), 0)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            DocumentContainer.objects.create(name='plan.txt', description="plan", parent_id=2, sharekey=doc.sharekey,
+                                             date_creation=current_date, date_modification=current_date)
+
+    def test_miniature_async(self):
+        create_doc(self.factory.user)
+        doc1 = DocumentContainer.objects.get(id=5)
+        self.assertFalse(get_storage().exists(doc1.miniature_name))
+        self.assertEqual(doc1.get_image(), "mdi:mdi-image-outline")
+        self.assertTrue(ThumbnailQueue.is_pending(doc1.miniature_key) or get_storage().exists(doc1.miniature_name))
+        self.assertTrue(ThumbnailQueue.wait(60))
+        self.assertTrue(get_storage().exists(doc1.miniature_name))
+        from PIL import Image
+        for height in (64, 200, 800):
+            with Image.open(get_storage().path(doc1.get_miniature_name(height))) as image:
+                self.assertEqual(image.format, 'WEBP')
+                self.assertEqual(image.size[1], min(height, 419), height)
+
+        self.factory.xfer = DocumentMosaic()
+        self.calljson('/lucterios.documents/documentMosaic', {"document": "2", 'MOSAIC_DIM%document': 0}, False)
+        self.assert_json_equal('', "document/@0/image", "http://testserver/lucterios.documents/files/5/miniature?size=64&v=", True)
+        self.factory.xfer = DocumentMosaic()
+        self.calljson('/lucterios.documents/documentMosaic', {"document": "2"}, False)
+        self.assert_observer('core.custom', 'lucterios.documents', 'documentMosaic')
+        self.assert_json_equal('', "document/@0/id", "5")
+        self.assert_json_equal('', "document/@0/image", "http://testserver/lucterios.documents/files/5/miniature?size=200&v=", True)
+
+        with open(join(dirname(__file__), 'docs', 'fr', 'showdoc.png'), 'rb') as file_doc:
+            with self.captureOnCommitCallbacks(execute=False) as callbacks:
+                doc1.content = file_doc
+        self.assertFalse(get_storage().exists(doc1.miniature_name))
+        self.assertEqual(len(callbacks), 2)
+        for callback in callbacks:
+            callback()
+        self.assertTrue(ThumbnailQueue.wait(60))
+        self.assertTrue(get_storage().exists(doc1.miniature_name))
+        # outside the mosaic (print, grid), the miniature stays inline even with a request
+        doc1 = DocumentContainer.objects.get(id=5)
+        doc1.set_context(self.factory.xfer)
+        self.assertTrue(doc1.get_image().startswith("data:image/webp;base64,"))
+
+        doc2 = DocumentContainer.objects.get(id=6)
+        with self.settings(DOCUMENTS_THUMBNAILS={'workers': 0}):
+            self.assertTrue(doc2.get_image().startswith("data:image/webp;base64,UklGR"))
+        self.assertFalse(ThumbnailQueue.is_pending(doc2.miniature_key))
+
+    def test_miniature_endpoint(self):
+        create_doc(self.factory.user)
+        response = self.client.get('/lucterios.documents/files/5/miniature')
+        self.assertEqual(response.status_code, 403)
+        root_doc = DocumentContainer.objects.create(name='root.png', description="root", parent=None, creator=self.factory.user,
+                                                    date_creation=timezone.now(), date_modification=timezone.now())
+        response = self.client.get('/lucterios.documents/files/%d/miniature' % root_doc.id)
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(ThumbnailQueue.is_pending(root_doc.miniature_key))
+        self.client.force_login(LucteriosUser.objects.create(username='nobody'))
+        response = self.client.get('/lucterios.documents/files/%d/miniature' % root_doc.id)
+        self.assertEqual(response.status_code, 403)
+        self.client.force_login(LucteriosUser.objects.get(username='admin'))
+        response = self.client.get('/lucterios.documents/files/5/miniature')
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(ThumbnailQueue.wait(60))
+        doc1 = DocumentContainer.objects.get(id=5)
+        self.assertTrue(get_storage().exists(doc1.miniature_name))
+
+        self.factory.xfer = DocumentMosaic()
+        self.calljson('/lucterios.documents/documentMosaic', {"document": "2"}, False)
+        self.assert_observer('core.custom', 'lucterios.documents', 'documentMosaic')
+        miniature_url = self.get_json_path('document')[0]['image']
+        self.assertTrue(miniature_url.startswith("http://testserver/lucterios.documents/files/5/miniature?size=200&v="), miniature_url)
+        response = self.client.get(miniature_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(b''.join(response.streaming_content)[8:12], b'WEBP')
+        self.assertEqual(response['ETag'], '"%s"' % miniature_url.split('&v=')[1])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertIn('private', response['Cache-Control'])
+        response = self.client.get(miniature_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        self.factory.xfer = DocumentMosaic()
+        self.calljson('/lucterios.documents/documentMosaic', {"document": "2", 'MINIATURE_INLINE': True}, False)
+        self.assert_json_equal('', "document/@0/image", "data:image/webp;base64,UklGR", True)
+        self.factory.xfer = DocumentShow()
+        self.calljson('/lucterios.documents/documentShow', {"document": "5"}, False)
+        self.assert_json_equal('IMAGE', 'img', "data:image/webp;base64,UklGR", True)
+        response = self.client.get('/lucterios.documents/files/0/miniature')
+        self.assertEqual(response.status_code, 404)
+
+    def test_mimetype(self):
+        create_doc(self.factory.user)
+        self.assertEqual(DocumentContainer.objects.filter(mimetype__isnull=True).count(), 3)
+        out = StringIO()
+        call_command('documents_mimetype', batch_size=2, stdout=out)
+        self.assertIn('3 document(s) detected, 0 remaining', out.getvalue())
+        self.assertEqual(list(DocumentContainer.objects.order_by().values_list('mimetype', flat=True).distinct()), ['image/png'])
+
+        doc1 = DocumentContainer.objects.get(id=5)
+        doc1.content = 'Lorem ipsum dolor sit amet\n' * 20
+        self.assertEqual(doc1.mimetype, 'text/plain')
+        doc1 = DocumentContainer.objects.get(id=5)
+        self.assertEqual(doc1.mimetype, 'text/plain')
+        self.assertEqual(doc1.get_image(), "mdi:mdi-text-box-outline")
+        doc1.name = 'notes'
+        self.assertIn('txt', DocEditor('http://testserver', doc1).doc_extensions)
+        doc1.name = 'notes.csv'
+        self.assertEqual(DocEditor('http://testserver', doc1).doc_extensions, ['csv'])
+        doc1.content = ''
+        self.assertIsNone(DocumentContainer.objects.get(id=5).mimetype)
+
+    def test_miniature_pdf(self):
+        from PIL import Image
+        if find_spec('pdf2image') is None:
+            self.skipTest('pdf2image not installed')
+        poppler_path = DocumentContainer.get_popper_path()
+        if which('pdftoppm', path=poppler_path) is None or which('pdfinfo', path=poppler_path) is None:
+            self.skipTest('poppler not installed')
+        pdf_file = BytesIO()
+        Image.new('RGB', (600, 800), 'white').save(pdf_file, 'PDF')
+        current_date = create_doc(self.factory.user)
+        doc_pdf = DocumentContainer.objects.create(name='scan.pdf', description="scan", parent_id=2, creator=self.factory.user,
+                                                   date_creation=current_date, date_modification=current_date)
+        doc_pdf.content = pdf_file.getvalue()
+        self.assertEqual(doc_pdf.mimetype, 'application/pdf')
+        self.assertEqual(doc_pdf.get_image(), "mdi:mdi-file-pdf-box")
+        self.assertTrue(ThumbnailQueue.wait(120))
+        self.assertFalse(ThumbnailQueue.is_pending(doc_pdf.miniature_key))
+        self.assertTrue(get_storage().exists(doc_pdf.miniature_name))
+        with Image.open(get_storage().path(doc_pdf.get_miniature_name(800))) as image:
+            self.assertEqual(image.size, (600, 800))
+        with Image.open(get_storage().path(doc_pdf.miniature_name)) as image:
+            self.assertEqual(image.size[1], MINIATURE_HEIGHT)
+
+    def test_miniature_worker_memory(self):
+        from resource import getrlimit, RLIMIT_AS
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_context
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn'), initializer=limit_worker_memory, initargs=(512,)) as executor:
+            self.assertEqual(executor.submit(getrlimit, RLIMIT_AS).result(), (512 * 1024 * 1024, 512 * 1024 * 1024))
+
+    def test_miniature_prewarm(self):
+        create_doc(self.factory.user)
+        out = StringIO()
+        call_command('documents_miniatures', folder=2, workers=0, stdout=out)
+        self.assertIn('2 miniature(s) created, 0 failed', out.getvalue())
+        self.assertTrue(get_storage().exists(DocumentContainer.objects.get(id=5).miniature_name))
+        self.assertTrue(get_storage().exists(DocumentContainer.objects.get(id=7).miniature_name))
+        self.assertFalse(get_storage().exists(DocumentContainer.objects.get(id=6).miniature_name))
+        out = StringIO()
+        call_command('documents_miniatures', folder=2, workers=0, stdout=out)
+        self.assertIn('0 miniature(s) created, 0 failed', out.getvalue())
+        out = StringIO()
+        call_command('documents_miniatures', workers=1, batch_size=1, stdout=out)
+        self.assertIn('1 miniature(s) created, 0 failed', out.getvalue())
+        self.assertTrue(get_storage().exists(DocumentContainer.objects.get(id=6).miniature_name))
+
+        doc1 = DocumentContainer.objects.get(id=5)
+        with open(join(dirname(__file__), 'docs', 'fr', 'showdoc.png'), 'rb') as file_doc:
+            doc1.content = file_doc.read()
+        self.assertFalse(get_storage().exists(doc1.miniature_name))
+        self.factory.xfer = FolderMiniatures()
+        self.calljson('/lucterios.documents/folderMiniatures', {'folder': 2, 'CONFIRME': 'YES'}, False)
+        self.assert_observer('core.dialogbox', 'lucterios.documents', 'folderMiniatures')
+        self.assert_json_equal('', 'text', '1 miniature(s) en préparation')
+        self.assertTrue(ThumbnailQueue.wait(60))
+        self.assertTrue(get_storage().exists(doc1.miniature_name))
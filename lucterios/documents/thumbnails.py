@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.documents package
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+from _io import BytesIO
+from zipfile import ZipFile
+from shutil import copyfileobj
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import monotonic, sleep
+from logging import getLogger
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+MINIATURE_HEIGHT = 200
+CHUNK_SIZE = 64 * 1024
+
+MINIATURE_HEIGHTS = (64, 200, 800)
+
+MINIATURE_CONTENT_TYPES = {
+    'webp': 'image/webp',
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+}
+
+DEFAULT_THUMBNAILS = {
+    'workers': 2,
+    'start_method': 'spawn',
+    'inline': False,
+    'max_age': 365 * 24 * 3600,
+    'format': 'webp',
+    'quality': 80,
+    'timeout': 60,
+    'memory_limit': 1024,
+}
+
+
+def get_thumbnails_config():
+    config = dict(DEFAULT_THUMBNAILS)
+    config.update(getattr(settings, 'DOCUMENTS_THUMBNAILS', {}))
+    return config
+
+
+def get_miniature_version(miniature_stat):
+    return "%x-%x" % (miniature_stat.st_mtime_ns, miniature_stat.st_size)
+
+
+def get_miniature_height(height):
+    # smallest rendition at least as high as requested
+    for miniature_height in MINIATURE_HEIGHTS:
+        if miniature_height >= height:
+            return miniature_height
+    return MINIATURE_HEIGHTS[-1]
+
+
+def resize_miniatures(image, heights, image_format, quality):
+    image = image.convert("RGB")
+    miniatures = {}
+    for height in sorted(heights, reverse=True):
+        # each rendition is scaled down from the previous (larger) one
+        if image.size[1] > height:
+            image = image.resize((max(int(image.size[0] * height / image.size[1]), 1), height))
+        image_file = BytesIO()
+        image.save(image_file, image_format.upper(), quality=quality)
+        miniatures[height] = image_file.getvalue()
+    return miniatures
+
+
+def miniature_image_outline(doc_file, height, poppler_path, timeout):
+    from PIL import Image
+    image = Image.open(doc_file)
+    image.draft("RGB", (image.size[0] * height // max(image.size[1], 1), height))
+    return image
+
+
+def miniature_file_chart_outline(doc_file, height, poppler_path, timeout):
+    from PIL import Image
+    from cairosvg import svg2png
+    return Image.open(BytesIO(svg2png(file_obj=doc_file, output_height=height)))
+
+
+def miniature_file_pdf_box(doc_file, height, poppler_path, timeout):
+    # Download "pdfinfo" : https://www.xpdfreader.com/download.html (Xpdf command line tools)
+    from pdf2image import convert_from_path
+    with NamedTemporaryFile(suffix='.pdf') as pdf_file:
+        copyfileobj(doc_file, pdf_file, CHUNK_SIZE)
+        pdf_file.flush()
+        # only the first page, rendered by poppler directly at the miniature height
+        images_list = convert_from_path(pdf_file.name, first_page=1, last_page=1, size=(None, height),
+                                        poppler_path=poppler_path, timeout=timeout)
+    if len(images_list) > 0:
+        return images_list[0]
+    return None
+
+
+MINIATURE_BUILDERS = {
+    'image_outline': miniature_image_outline,
+    'file_chart_outline': miniature_file_chart_outline,
+    'file_pdf_box': miniature_file_pdf_box,
+}
+
+
+def limit_worker_memory(memory_limit):
+    # pool initializer: the limit is inherited by the poppler subprocesses
+    if memory_limit:
+        try:
+            from resource import setrlimit, RLIMIT_AS
+            setrlimit(RLIMIT_AS, (memory_limit * 1024 * 1024, memory_limit * 1024 * 1024))
+        except (ImportError, ValueError, OSError) as err:
+            getLogger("lucterios.documents").warning('miniature worker memory not limited: %s', err)
+
+
+def create_miniatures(container_path, kind, renditions, poppler_path=None, image_format='webp', quality=80, timeout=None):
+    # run in a worker process: only depends on the container file, never on the database
+    with ZipFile(container_path, 'r') as zip_ref:
+        file_list = zip_ref.namelist()
+        if len(file_list) == 0:
+            return {}
+        with zip_ref.open(file_list[0]) as doc_file:
+            image = MINIATURE_BUILDERS[kind](doc_file, max(renditions.values()), poppler_path, timeout)
+            if image is None:
+                return {}
+            miniatures = resize_miniatures(image, set(renditions.values()), image_format, quality)
+    return {miniature_name: miniatures[height] for miniature_name, height in renditions.items()}
+
+
+def get_miniature_args(config, container_path, kind, renditions, poppler_path=None):
+    return (container_path, kind, renditions, poppler_path, config['format'], int(config['quality']), config['timeout'])
+
+
+def create_executor(config, workers=None):
+    return ProcessPoolExecutor(max_workers=int(config['workers'] if workers is None else workers), mp_context=get_context(config['start_method']),
+                               initializer=limit_worker_memory, initargs=(int(config['memory_limit']),))
+
+
+def save_miniatures(miniatures):
+    from lucterios.documents.storage import get_storage
+    storage = get_storage()
+    for miniature_name, miniature in miniatures.items():
+        storage.save(miniature_name, miniature)
+
+
+class ThumbnailQueue(object):
+    # process pool building miniatures out of the request; results are saved by the parent process
+
+    _lock = Lock()
+    _executor = None
+    _pending = {}
+
+    @classmethod
+    def _get_executor(cls, config):
+        if cls._executor is None:
+            cls._executor = create_executor(config)
+        return cls._executor
+
+    @classmethod
+    def submit(cls, miniature_key, container_path, kind, renditions, poppler_path=None):
+        config = get_thumbnails_config()
+        args = get_miniature_args(config, container_path, kind, renditions, poppler_path)
+        if int(config['workers']) <= 0:
+            try:
+                save_miniatures(create_miniatures(*args))
+            except Exception as err:
+                getLogger("lucterios.documents").warning('miniature %s not created: %s', miniature_key, err)
+                return False
+            return True
+        with cls._lock:
+            if miniature_key in cls._pending:
+                return False
+            try:
+                future = cls._get_executor(config).submit(create_miniatures, *args)
+            except BrokenProcessPool:
+                cls._executor = None
+                future = cls._get_executor(config).submit(create_miniatures, *args)
+            cls._pending[miniature_key] = future
+        future.add_done_callback(lambda done_future: cls._done(miniature_key, done_future))
+        return False
+
+    @classmethod
+    def _done(cls, miniature_key, future):
+        with cls._lock:
+            if cls._pending.get(miniature_key) is not future:
+                return
+            del cls._pending[miniature_key]
+            try:
+                save_miniatures(future.result())
+            except Exception as err:
+                getLogger("lucterios.documents").warning('miniature %s not created: %s', miniature_key, err)
+
+    @classmethod
+    def cancel(cls, miniature_key):
+        with cls._lock:
+            future = cls._pending.pop(miniature_key, None)
+        if future is not None:
+            future.cancel()
+
+    @classmethod
+    def is_pending(cls, miniature_key):
+        with cls._lock:
+            return miniature_key in cls._pending
+
+    @classmethod
+    def wait(cls, timeout=None):
+        # results are saved by the done callbacks, called once the futures are already signaled
+        end_time = None if timeout is None else monotonic() + timeout
+        while True:
+            with cls._lock:
+                futures = list(cls._pending.values())
+            if len(futures) == 0:
+                return True
+            if (end_time is not None) and (monotonic() > end_time):
+                return False
+            wait_futures(futures, None if end_time is None else max(end_time - monotonic(), 0))
+            sleep(0.01)
+
+    @classmethod
+    def shutdown(cls):
+        with cls._lock:
+            executor = cls._executor
+            cls._executor = None
+            cls._pending.clear()
+        if executor is not None:
+            executor.shutdown(wait=True)
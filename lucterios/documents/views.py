@@ -28,11 +28,15 @@ from os import makedirs, walk
 from shutil import rmtree
 from zipfile import ZipFile
 from logging import getLogger
+import json
+from datetime import datetime, timezone as dt_timezone
 
 from django.utils.translation import gettext_lazy as _
 from django.apps.registry import apps
 from django.db.models import Q
-from django.db.models.query import QuerySet
+from django.db.models import Value, DateTimeField, F
+from django.db.models.functions import Coalesce, Lower
+from django.utils.dateparse import parse_datetime
 from django.core.exceptions import ObjectDoesNotExist
 from django.views.decorators.http import require_GET
 from django.views import View
@@ -45,7 +49,7 @@ from lucterios.framework.tools import MenuManage, FORMTYPE_NOMODAL, ActionsManag
     CLOSE_NO, FORMTYPE_REFRESH, SELECT_SINGLE, SELECT_NONE, \
     WrapAction, CLOSE_YES, SELECT_MULTI, get_url_from_request, FORMTYPE_MODAL
 from lucterios.framework.xfercomponents import XferCompButton, XferCompLabelForm, \
-    XferCompImage, XferCompUpLoad, XferCompDownLoad, XferCompSelect, XferCompMosaic, MOSAIC_ORDER
+    XferCompImage, XferCompUpLoad, XferCompDownLoad, XferCompSelect, XferCompMosaic
 from lucterios.framework.error import LucteriosException, IMPORTANT
 from lucterios.framework import signal_and_lock
 from lucterios.framework.xfergraphic import XferContainerAcknowledge
@@ -54,8 +58,10 @@ from lucterios.CORE.parameters import notfree_mode_connect
 from lucterios.CORE.models import LucteriosGroup, LucteriosUser
 from lucterios.CORE.editors import XferSavedCriteriaSearchEditor
 
-from lucterios.documents.models import FolderContainer, DocumentContainer, AbstractContainer
+from lucterios.documents.models import FolderContainer, DocumentContainer, AbstractContainer, FolderPermission
 from lucterios.documents.doc_editors import DocEditor
+from lucterios.documents.storage import get_storage
+from lucterios.documents.thumbnails import ThumbnailQueue, get_thumbnails_config, get_miniature_version, get_miniature_height, MINIATURE_HEIGHTS, MINIATURE_CONTENT_TYPES
 
 
 MenuManage.add_sub("documents.conf", "core.extensions", short_icon='mdi:mdi-folder-cog-outline', caption=_("Document"), pos=10)
@@ -224,6 +230,23 @@ class FolderExtract(FolderImportExport):
         self.open_zipfile('extract.zip')
 
 
+@ActionsManage.affect_grid(_("Miniatures"), short_icon='mdi:mdi-image-multiple-outline', unique=SELECT_SINGLE)
+@MenuManage.describ('documents.change_folder')
+class FolderMiniatures(XferContainerAcknowledge):
+    caption = _("Prepare miniatures")
+    short_icon = 'mdi:mdi-folder-cog'
+    model = FolderContainer
+    field_id = 'folder'
+
+    def fillresponse(self):
+        if self.confirme(_('Do you want to prepare the missing miniatures of this folder and its sub-folders?')):
+            nb_doc = 0
+            for doc, miniature_request in DocumentContainer.missing_miniatures(self.item):
+                ThumbnailQueue.submit(doc.miniature_key, *miniature_request)
+                nb_doc += 1
+            self.message(_('%d miniature(s) in preparation') % nb_doc)
+
+
 if not apps.is_installed("lucterios.contacts"):
     MenuManage.add_sub("office", None, short_icon='mdi:mdi-monitor', caption=_("Office"), desc=_("Office tools"), pos=70)
 
@@ -287,8 +310,9 @@ class DocumentShow(XferShowEditor):
         if (self.item.id is None) and (current_folder != 0):
             self.item = DocumentContainer.objects.get(id=current_folder)
         XferShowEditor.fillresponse(self)
+        self.item.miniature_inline = True
         mini_image = self.item.get_image()
-        self.get_components('img').set_value(mini_image, '#' if mini_image.startswith('mdi:') else 'png')
+        self.get_components('img').set_value(mini_image, '#' if mini_image.startswith('mdi:') else self.item.miniature_format)
 
 
 @ActionsManage.affect_show(_('Editor'), short_icon='mdi:mdi-file-outline', modal=FORMTYPE_NOMODAL,
@@ -396,6 +420,78 @@ class DocumentDel(XferDelete):
             XferContainerAcknowledge.fillresponse(self)
 
 
+MOSAIC_CURSOR = 'MOSAIC_CURSOR%'
+
+
+class ContainerMosaic(XferCompMosaic):
+    # mosaic paginated by keyset (order value, id) when moving to the next page
+
+    def _get_cursor(self, xfer_custom, order_field):
+        try:
+            cursor = json.loads(xfer_custom.getparam(MOSAIC_CURSOR + self.name, ''))
+            if (cursor['order'] == order_field) and (cursor['page'] == self.page_num - 1):
+                key_value = cursor['key']
+                if cursor.get('type') == 'datetime':
+                    key_value = parse_datetime(key_value)
+                return key_value, cursor['id']
+        except (ValueError, TypeError, KeyError, AttributeError):
+            pass
+        return None
+
+    def _set_cursor(self, xfer_custom, order_field, last_item):
+        key_value = last_item.mosaic_key
+        cursor = {'order': order_field, 'page': self.page_num, 'id': last_item.id, 'key': key_value}
+        if isinstance(key_value, datetime):
+            cursor['type'] = 'datetime'
+            cursor['key'] = key_value.isoformat()
+        xfer_custom.params[MOSAIC_CURSOR + self.name] = json.dumps(cursor)
+
+    def set_model(self, query_set, xfer_custom=None, attr_image="image", attr_name="name", attr_info="info", attr_group="group"):
+        if xfer_custom is not None:
+            self._order_list_field(query_set.model)
+        self.nb_items = query_set.count()
+        record_min, record_max = self.define_page(query_set.model, xfer_custom)
+        order_field = self.order_field if self.order_field is not None else 'id'
+        order_name = order_field.replace('-', '')
+        descending = order_field.startswith('-')
+        query_set = query_set.annotate(mosaic_key=Lower(order_name) if self.order_insensitive_case else F(order_name))
+        query_set = query_set.order_by(*[('-' if descending else '') + key_name for key_name in ('mosaic_key', 'id')])
+        cursor = self._get_cursor(xfer_custom, order_field) if (xfer_custom is not None) and (self.page_num > 0) else None
+        if (cursor is not None) and (cursor[0] is not None):
+            key_value, key_id = cursor
+            if descending:
+                query_set = query_set.filter(Q(mosaic_key__lt=key_value) | Q(mosaic_key=key_value, id__lt=key_id))
+            else:
+                query_set = query_set.filter(Q(mosaic_key__gt=key_value) | Q(mosaic_key=key_value, id__gt=key_id))
+            query_set = query_set[:record_max - record_min]
+        else:
+            query_set = query_set[record_min:record_max]
+        last_item = None
+        miniature_height = MINIATURE_HEIGHTS[min(max(int(self.img_dim), 0), len(MINIATURE_HEIGHTS) - 1)]
+        # only the mosaic shows miniatures by URL: prints and grids keep them inline
+        miniature_inline = get_thumbnails_config()['inline']
+        if xfer_custom is not None:
+            miniature_inline = xfer_custom.getparam('MINIATURE_INLINE', miniature_inline)
+        for value in query_set:
+            last_item = value
+            child = value.get_final_child()
+            child.set_context(xfer_custom)
+            child.miniature_height = miniature_height
+            child.miniature_inline = miniature_inline
+            self.value.append({
+                "id": child.id,
+                "image": getattr(child, attr_image, ""),
+                "name": getattr(child, attr_name, ""),
+                "info": getattr(child, attr_info, ""),
+                "group": getattr(child, attr_group, ""),
+            })
+        if xfer_custom is not None:
+            if (last_item is not None) and (self.page_num + 1 < self.page_max):
+                self._set_cursor(xfer_custom, order_field, last_item)
+            elif (MOSAIC_CURSOR + self.name) in xfer_custom.params:
+                del xfer_custom.params[MOSAIC_CURSOR + self.name]
+
+
 @MenuManage.describ('documents.change_document', FORMTYPE_NOMODAL, 'documents.actions', _("Management of documents"))
 class DocumentMosaic(XferListEditor):
     caption = _("Documents")
@@ -423,37 +519,26 @@ class DocumentMosaic(XferListEditor):
             self.add_component(lbl)
             self.filter = Q(parent=self.curren_item)
             if notfree_mode_connect() and not self.request.user.is_superuser:
-                filter_folder = Q(foldercontainer__isnull=False) & Q(foldercontainer__viewer__in=self.request.user.groups.all())
-                filter_document = Q(documentcontainer__isnull=False) & Q(documentcontainer__parent__viewer__in=self.request.user.groups.all())
+                viewable_folders = FolderPermission.viewable_folders(self.request.user)
+                filter_folder = Q(foldercontainer__isnull=False) & Q(id__in=viewable_folders)
+                filter_document = Q(documentcontainer__isnull=False) & Q(parent_id__in=viewable_folders)
                 self.filter = self.filter & (filter_folder | filter_document)
         else:
             self.curren_item = AbstractContainer()
             lbl.set_value('>')
             self.filter = Q(parent=None)
             if notfree_mode_connect() and not self.request.user.is_superuser:
-                filter_folder = Q(foldercontainer__isnull=False) & Q(foldercontainer__viewer__in=self.request.user.groups.all())
+                filter_folder = Q(foldercontainer__isnull=False) & Q(id__in=FolderPermission.viewable_folders(self.request.user))
                 self.filter = self.filter & filter_folder
 
     def get_items_from_filter(self):
-        class ContainerQuerySet(QuerySet):
-            def __init__(self, model, *args, initial=[], **kwargs):
-                super(ContainerQuerySet, self).__init__(model=model, *args, **kwargs)
-                self._result_cache = initial
-
-            def order_by(self, *field_names):
-                return self
-        order_field = self.getparam(MOSAIC_ORDER + self.field_id, '')
-        items = XferListEditor.get_items_from_filter(self)
-        if order_field.replace('-', '') == 'datemodif':
-            items = ContainerQuerySet(
-                model=AbstractContainer,
-                initial=sorted(items, key=lambda doc: str(doc.date_modif).lower(), reverse=order_field.startswith('-'))
-            )
-        return items
+        items = XferListEditor.get_items_from_filter(self).select_related('foldercontainer', 'documentcontainer', 'documentcontainer__modifier')
+        # folders have no modification date: keep them after documents, as the previous textual sort did
+        return items.annotate(datemodif=Coalesce('documentcontainer__date_modification', Value(datetime(9999, 12, 31, tzinfo=dt_timezone.utc)), output_field=DateTimeField()))
 
     def fill_grid(self, row, model, field_id, items):
         root_document = self.getparam('root', 0)
-        mosaic = XferCompMosaic(field_id)
+        mosaic = ContainerMosaic(field_id)
         mosaic.adding_fiedsorder.append(('datemodif', _('date modification')))
         mosaic.set_model(items, self, "image", "indentification", "html_info", "group")
         mosaic.set_location(0, row + 1, 4)
@@ -487,7 +572,7 @@ class DocumentSearch(XferSavedCriteriaSearchEditor):
         if notfree_mode_connect() and not self.request.user.is_superuser:
             if self.filter is None:
                 self.filter = Q()
-            self.filter = self.filter & (Q(parent=None) | Q(parent__viewer__in=self.request.user.groups.all()))
+            self.filter = self.filter & (Q(parent=None) | Q(parent_id__in=FolderPermission.viewable_folders(self.request.user)))
 
     def fillresponse(self):
         XferSearchEditor.fillresponse(self)
@@ -522,7 +607,7 @@ class DownloadFile(XferContainerAcknowledge):
     methods_allowed = ('GET', 'PUT')
 
     def request_handling(self, request, *args, **kwargs):
-        from django.http.response import StreamingHttpResponse, HttpResponse
+        from django.http.response import HttpResponse
         getLogger("lucterios.documents").debug(">> DownloadFile get %s [%s]", request.path, request.user)
         try:
             self._initialize(request, *args, **kwargs)
@@ -534,7 +619,7 @@ class DownloadFile(XferContainerAcknowledge):
                     doc = DocumentContainer.objects.get(name=filename, sharekey=shared)
                 else:
                     doc = DocumentContainer.objects.get(id=fileid, name=filename)
-                response = StreamingHttpResponse(doc.content, content_type='application/octet-stream')
+                response = get_content_response(doc, request, content_type='application/octet-stream')
                 response['Content-Disposition'] = 'attachment; filename=%s' % doc.name
                 if hasattr(request, 'session') and hasattr(request.session, 'accessed'):
                     request.session.accessed = False
@@ -548,6 +633,60 @@ class DownloadFile(XferContainerAcknowledge):
             getLogger("lucterios.documents").debug("<< DownloadFile get %s [%s]", request.path, request.user)
 
 
+def get_content_range(range_header, total_size):
+    if not range_header.startswith('bytes=') or (',' in range_header):
+        return None
+    range_start, _sep, range_end = range_header[6:].strip().partition('-')
+    try:
+        if range_start == '':
+            start = max(total_size - int(range_end), 0)
+            end = total_size - 1
+        else:
+            start = int(range_start)
+            end = min(int(range_end), total_size - 1) if range_end != '' else total_size - 1
+    except ValueError:
+        return None
+    if (start > end) or (start >= total_size):
+        raise ValueError(range_header)
+    return start, end
+
+
+def get_content_response(doc, request, content_type=None):
+    from django.http.response import StreamingHttpResponse, FileResponse, HttpResponse
+    from django.utils.cache import get_conditional_response
+    from django.utils.http import http_date, quote_etag
+    etag = quote_etag(doc.checksum) if doc.checksum is not None else None
+    last_modified = int(doc.date_modification.timestamp()) if doc.date_modification is not None else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        total_size = doc.content_size
+        content_range = None
+        if_range = request.META.get('HTTP_IF_RANGE', '')
+        if (request.method == 'GET') and ((if_range == '') or (if_range == etag)):
+            try:
+                content_range = get_content_range(request.META.get('HTTP_RANGE', ''), total_size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % total_size
+                return response
+        start, end = content_range if content_range is not None else (0, None)
+        stored_content = doc.open_stored_content(start, end)
+        if stored_content is not None:
+            response = FileResponse(stored_content, content_type=content_type)
+        else:
+            response = StreamingHttpResponse(doc.iter_content(start=start, end=end), content_type=content_type)
+        if content_range is not None:
+            response.status_code = 206
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, total_size)
+            response['Content-Length'] = str(end - start + 1)
+        response['Accept-Ranges'] = 'bytes'
+    if etag is not None:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
 @MenuManage.describ('')
 class UploadFile(XferContainerAcknowledge):
     short_icon = 'mdi:mdi-folder-outline'
@@ -609,7 +748,7 @@ def check_file_info(request, file_id):
         doc, can_write, user = perm_res
         res = {
             'BaseFileName': doc.name,
-            'Size': len(doc.content.read()),
+            'Size': doc.content_size,
             'UserId': str(user.id) if user is not None else '0',
             'OwnerId': str(doc.creator.id) if doc.creator is not None else '0',
             'UserCanWrite': can_write,
@@ -631,35 +770,81 @@ def check_file_info(request, file_id):
         return HttpResponseServerError()
 
 
+@require_GET
+def get_miniature(request, file_id):
+    from django.http.response import HttpResponseNotFound, HttpResponseForbidden, HttpResponseBadRequest, FileResponse
+    from django.utils.cache import get_conditional_response, patch_cache_control
+    from django.utils.http import quote_etag
+    if notfree_mode_connect() and not (request.user.is_authenticated and request.user.has_perm('documents.change_document')):
+        return HttpResponseForbidden(b"no permission")
+    try:
+        doc = DocumentContainer.objects.get(id=file_id)
+    except (ValueError, ObjectDoesNotExist):
+        return HttpResponseNotFound(f"File id {file_id} no found".encode())
+    if notfree_mode_connect() and not request.user.is_superuser and (doc.parent is not None) and doc.parent.cannot_view(request.user):
+        return HttpResponseForbidden(b"no permission")
+    try:
+        doc.miniature_height = get_miniature_height(int(request.GET.get('size', doc.MINIATURE_HEIGHT)))
+    except ValueError:
+        return HttpResponseBadRequest(b"invalid size")
+    storage = get_storage()
+    miniature_stat = storage.stat(doc.miniature_name)
+    if miniature_stat is None:
+        doc.generate_miniature()
+        return HttpResponseNotFound(b"Miniature not available.")
+    etag = quote_etag(get_miniature_version(miniature_stat))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = FileResponse(storage.open(doc.miniature_name), content_type=MINIATURE_CONTENT_TYPES[doc.miniature_format])
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, max_age=get_thumbnails_config()['max_age'], immutable=True)
+    return response
+
+
 class FileContentView(View):
 
     @staticmethod
     def get(request, file_id):
-        from django.http.response import HttpResponse, HttpResponseBase, HttpResponseServerError
+        from django.http.response import HttpResponseBase, HttpResponseServerError
         getLogger("lucterios.documents").info(f"GetFile: file id: {file_id}, access token: {request.GET['access_token']}")
         try:
             perm_res = file_check_permission(file_id, request)
             if isinstance(perm_res, HttpResponseBase):
                 return perm_res
             doc, _can_write, _user_id = perm_res
-            return HttpResponse(doc.content.read())
+            return get_content_response(doc, request)
         except Exception:
             getLogger("lucterios.documents").exception("FileContentView get failure!!!")
             return HttpResponseServerError()
 
     @staticmethod
     def post(request, file_id):
-        from django.http.response import HttpResponse, HttpResponseBase, HttpResponseNotFound, HttpResponseServerError
+        from django.http.response import HttpResponse, HttpResponseBase, HttpResponseBadRequest, HttpResponseServerError
+        from django.http.request import UnreadablePostError
         getLogger("lucterios.documents").info(f"PutFile: file id: {file_id}, access token: {request.GET['access_token']}")
-        if not request.body:
-            return HttpResponseNotFound(b'Not possible to get the file content.')
+        content_length = request.META.get('CONTENT_LENGTH') or ''
+        if content_length == '':
+            # chunked body: read until the end of the stream, once de-chunked by the server
+            if not request.META.get('wsgi.input_terminated', False):
+                return HttpResponse(b'Length required.', status=411)
+            stream = request.META['wsgi.input']
+        elif not content_length.isdigit():
+            return HttpResponseBadRequest(b'Not possible to get the file content.')
+        else:
+            stream = request
         try:
             perm_res = file_check_permission(file_id, request)
             if isinstance(perm_res, HttpResponseBase):
                 return perm_res
             doc, _can_write, _user_id = perm_res
-            doc.content = request.read()
+            head = stream.read(2048)
+            if not head:
+                return HttpResponseBadRequest(b'Not possible to get the file content.')
+            doc.upload_content(stream, head)
             return HttpResponse()  # status 200
+        except UnreadablePostError:
+            getLogger("lucterios.documents").warning("FileContentView post: unreadable body")
+            return HttpResponseBadRequest(b'Not possible to get the file content.')
         except Exception:
             getLogger("lucterios.documents").exception("FileContentView post failure!!!")
             return HttpResponseServerError()
@@ -677,7 +862,7 @@ def summary_documents(xfer):
         xfer.add_component(lab)
         filter_result = Q()
         if notfree_mode_connect():
-            filter_result = filter_result & (Q(parent=None) | Q(parent__viewer__in=xfer.request.user.groups.all() if xfer.request.user.id is not None else []))
+            filter_result = filter_result & (Q(parent=None) | Q(parent_id__in=FolderPermission.viewable_folders(xfer.request.user)))
         nb_doc = len(DocumentContainer.objects.filter(*[filter_result]))
         lbl_doc = XferCompLabelForm('lbl_nbdocument')
         lbl_doc.set_location(0, row + 1, 4)
@@ -701,6 +886,7 @@ def summary_documents(xfer):
 def get_url_patterns(url_patterns):
     from django.urls import re_path
     url_patterns.append(re_path(r'^lucterios.documents/files/(.*)/contents', FileContentView.as_view()))
+    url_patterns.append(re_path(r'^lucterios.documents/files/(.*)/miniature', get_miniature))
     url_patterns.append(re_path(r'^lucterios.documents/files/(.*)', check_file_info))
     return True
 
@@ -58,6 +58,8 @@ setup(
     packages=["lucterios", "lucterios.documents"],
     package_data={
         "lucterios.documents.migrations": ['*'],
+        "lucterios.documents.management": ['*'],
+        "lucterios.documents.management.commands": ['*'],
         "lucterios.documents": ['build', 'images/*', 'locale/*/*/*', 'help/*'],
     },
     install_requires=["lucterios ~=2.7", "etherpad-lite ~=0.5", "requests", "mimetypes-magic ~=0.4", "pdf2image ~=1.17"],